@@ -1,6 +1,9 @@
 from .base import cachedprop
 from .task import Tasker, LockException
 from .storage import *
+from .cache import set_read_cache
+from .artifacts import ArtifactCache
 from .loader import use, taskmod
 from .set_tasker import SetTasker
+from .campaign import run_campaign
 from .progress import Monitor
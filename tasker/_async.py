@@ -0,0 +1,82 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""asyncio interface to tasks (Python 3 only).
+
+These become TaskUnit.async_call(), async_sync() and async_load(), and
+Tasker.gather(); the module is only imported where the syntax is supported.
+"""
+import asyncio
+import functools
+import threading
+
+# Held by threads running tasks that change the working directory
+_chdir_lock = threading.RLock()
+
+def _call_locked(tsk, lock, fcn, *args):
+    with tsk._span('lock_wait'):
+        lock.acquire()
+    try:
+        return fcn(*args)
+    finally:
+        lock.release()
+
+def _in_thread(tsk, executor, fcn, *args):
+    """Awaitable that calls fcn(*args) in 'executor' (or the loop's default).
+
+    Calls on behalf of taskers that change the working directory are
+    serialized, so they cannot interfere with each other.
+    """
+    if tsk.tasker.chdir:
+        fcn = functools.partial(_call_locked, tsk, _chdir_lock, fcn)
+    return asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(fcn, *args))
+
+
+async def async_call(self, executor=None):
+    """Coroutine counterpart of calling the task: sync, then load.
+
+    Runs in a thread from 'executor' (by default, the event loop's).
+    Only tasks whose taskers have chdir=False run concurrently with
+    each other; the rest take turns. A task needed by several of those
+    at once is run by one of them, while the others wait.
+    """
+    return await _in_thread(self, executor, self)
+
+async def async_sync(self, workers=None, threads=False, executor=None):
+    """Coroutine counterpart of sync(). See async_call()."""
+    await _in_thread(self, executor, self.sync, workers, threads)
+
+async def async_load(self, executor=None):
+    """Coroutine counterpart of load(). See async_call()."""
+    return await _in_thread(self, executor, self.load)
+
+async def gather(*tasks, limit=None, executor=None, return_exceptions=False):
+    """Call several tasks concurrently, from an asyncio event loop.
+
+    'tasks' are TaskUnit instances, possibly from many taskers. Returns a
+    list of their outputs, as from async_call(), in the same order.
+
+    limit : maximum number of tasks to work on at once (optional)
+    executor : where to run the work (default: the loop's executor)
+    return_exceptions : as for asyncio.gather()
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+    async def call(tsk):
+        if semaphore is None:
+            return await tsk.async_call(executor)
+        async with semaphore:
+            return await tsk.async_call(executor)
+    return await asyncio.gather(*[call(t) for t in tasks],
+                                return_exceptions=return_exceptions)
@@ -0,0 +1,144 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Resources used by task runs, and the history of those runs."""
+import six
+import os, sys, time
+import socket
+import pandas
+
+from .storage import JSONLines
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_RUNS_FILE = '.taskerruns.jsonl'
+
+# Columns of the run history, in order
+RUN_COLUMNS = ['task', 'started', 'outcome', 'wall_s', 'cpu_s', 'peak_rss_bytes',
+               'read_bytes', 'write_bytes', 'input_bytes', 'output_bytes',
+               'pid', 'host']
+
+
+def _io_counters():
+    """(bytes read, bytes written) from storage by this process, or Nones."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_time():
+    if resource is None:
+        return time.process_time()
+    total = 0.
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        total += ru.ru_utime + ru.ru_stime
+    return total
+
+
+def _peak_rss():
+    """Largest resident set size of this process so far, in bytes, or None."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024  # Linux: kB
+
+
+def total_size(filenames):
+    """Total size of the files in 'filenames' that exist (directories count as 0)."""
+    size = 0
+    for fn in filenames:
+        try:
+            if os.path.isfile(fn):
+                size += os.path.getsize(fn)
+        except OSError:
+            pass
+    return size
+
+
+class ResourceMeter(object):
+    """Measures the resources used between start() and stop().
+
+    CPU time includes that of this process (all threads) and of child
+    processes that have finished. Peak RSS is the high-water mark of the
+    whole process, so it describes one task well only when that task has
+    the process to itself (e.g. in a parallel sync). Bytes read and
+    written are as counted by the operating system (Linux only).
+    """
+    def start(self):
+        self.started = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+        self._io = _io_counters()
+        return self
+
+    def stop(self):
+        """Returns a dict of measurements."""
+        io = _io_counters()
+        return dict(
+            started=self.started,
+            wall_s=time.perf_counter() - self._wall,
+            cpu_s=_cpu_time() - self._cpu,
+            peak_rss_bytes=_peak_rss(),
+            read_bytes=None if io[0] is None or self._io[0] is None
+                        else io[0] - self._io[0],
+            write_bytes=None if io[1] is None or self._io[1] is None
+                         else io[1] - self._io[1],
+            pid=os.getpid(),
+            host=socket.gethostname(),
+            )
+
+
+def record_run(dirname, record):
+    """Append 'record' (a dict) to the run history in 'dirname'."""
+    JSONLines(DEFAULT_RUNS_FILE, dirname).append([record])
+
+
+def read_runs(dirname):
+    """Run history of 'dirname', as a DataFrame with columns RUN_COLUMNS.
+
+    'started' is converted to a datetime.
+    """
+    fo = JSONLines(DEFAULT_RUNS_FILE, dirname)
+    records = fo.read() if os.path.exists(fo.filepath) else []
+    runs = pandas.DataFrame(records, columns=RUN_COLUMNS)
+    runs['started'] = pandas.to_datetime(runs.started, unit='s')
+    return runs
+
+
+def summarize(runs, by='task'):
+    """Aggregate a run history (from read_runs()) by the columns in 'by'.
+
+    For each group, gives the number of runs and errors, the total and mean
+    wall and CPU time, the largest peak RSS, and the mean output size.
+    Sorted by total wall time, so the most expensive tasks come first.
+    """
+    grouped = runs.groupby(by)
+    summary = pandas.DataFrame({
+        'runs': grouped.size(),
+        'errors': grouped.outcome.apply(lambda o: int((o == 'error').sum())),
+        'total_wall_s': grouped.wall_s.sum(),
+        'mean_wall_s': grouped.wall_s.mean(),
+        'total_cpu_s': grouped.cpu_s.sum(),
+        'mean_cpu_s': grouped.cpu_s.mean(),
+        'max_peak_rss_bytes': grouped.peak_rss_bytes.max(),
+        'mean_output_bytes': grouped.output_bytes.mean(),
+        })
+    return summary.sort_values('total_wall_s', ascending=False)
@@ -0,0 +1,239 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Cache of task outputs shared between directories."""
+import six
+import os
+import stat
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+from path import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+_FICLONE = 0x40049409  # Linux ioctl to share a file's blocks (reflink)
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS artifacts (
+        key TEXT PRIMARY KEY, size INTEGER, last_used REAL)""",
+    # The cached files themselves, to recognize hard links to them
+    """CREATE TABLE IF NOT EXISTS files (
+        key TEXT, dev INTEGER, ino INTEGER, PRIMARY KEY (dev, ino))""",
+    ]
+
+
+def _reflink(src, dst):
+    """Make 'dst' share the contents of 'src' without copying. Raises OSError."""
+    if fcntl is None:
+        raise OSError('reflink not supported')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _clone(src, dst, hardlink=False):
+    """Put a copy of file 'src' at 'dst' (which must not exist), as cheaply as possible.
+
+    Returns True if 'dst' is a hard link to 'src', rather than a file of its own.
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass  # e.g. on another filesystem
+    try:
+        _reflink(src, dst)
+        return False
+    except (OSError, IOError):
+        if os.path.exists(dst):
+            os.unlink(dst)
+    shutil.copyfile(src, dst)
+    return False
+
+
+class ArtifactCache(object):
+    """Store of task outputs, addressed by what they were computed from.
+
+    A task with this cache (see the Tasker's 'artifact_cache' option) looks
+    up a key made from its name, the source of its function, its output
+    filenames, and the contents of its input files. If another directory has
+    already computed outputs under that key, they are put in place instead of
+    running the task. Otherwise the task runs, and its outputs are added.
+
+    'root' : directory that holds the cache. It can be shared by any number
+        of processes.
+    'max_bytes' : the least recently used entries are removed to keep the
+        total size below this. None for no limit.
+    'hardlink' : if true, outputs are hard links to the cached files, which
+        saves space and time, but makes them read-only, and gives all copies
+        of an output the same modification time. Otherwise they are reflinks
+        where the filesystem supports it, or else copies.
+
+    Tasks must not depend on anything other than their input files.
+    Only tasks whose outputs are all regular files are cached.
+    """
+    def __init__(self, root, max_bytes=None, hardlink=False):
+        self.root = Path(root).abspath()
+        self.max_bytes = max_bytes
+        self.hardlink = hardlink
+        self.root.makedirs_p()
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.root / 'index.sqlite'), timeout=60)
+            with conn:
+                for stmt in _SCHEMA:
+                    conn.execute(stmt)
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _entry_dir(self, key):
+        return self.root / key[:2] / key
+
+    def __contains__(self, key):
+        row = self._connect().execute('SELECT 1 FROM artifacts WHERE key = ?',
+                                      (key,)).fetchone()
+        return row is not None and self._entry_dir(key).isdir()
+
+    def owns(self, filename):
+        """True if 'filename' is (or may be) a hard link to a file in the cache.
+
+        Files that were linked from the cache stay read-only after their
+        entries are evicted, so any read-only file with other links counts.
+        """
+        try:
+            st = os.stat(str(filename))
+        except OSError:
+            return False
+        if st.st_nlink < 2:
+            return False
+        if not st.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+            return True
+        row = self._connect().execute('SELECT 1 FROM files WHERE dev = ? AND ino = ?',
+                                      (st.st_dev, st.st_ino)).fetchone()
+        return row is not None
+
+    def fetch(self, key, filenames, newer_than=None):
+        """Put the outputs stored under 'key' at 'filenames'.
+
+        Copies are given the current time as their modification time. Hard
+        links share that of the cached file, which is left alone, since it
+        is seen by every directory that links to it; where that is not later
+        than 'newer_than' (e.g. the newest input's), a copy is made instead.
+
+        Returns True if they were found, False if not.
+        """
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM artifacts WHERE key = ?',
+                        (key,)).fetchone() is None:
+            return False
+        entry = self._entry_dir(key)
+        try:
+            for i, fn in enumerate(filenames):
+                fn = Path(fn)
+                fn.dirname().makedirs_p()
+                tmpname = '%s.%i-%i._tmp' % (fn, os.getpid(),
+                                             threading.current_thread().ident)
+                src = entry / str(i)
+                hardlink = self.hardlink and (newer_than is None or
+                                              os.stat(src).st_mtime > newer_than)
+                try:
+                    if not _clone(src, tmpname, hardlink):
+                        os.utime(tmpname, None)  # Newer than the inputs
+                    os.replace(tmpname, fn)
+                finally:
+                    if os.path.exists(tmpname):
+                        os.unlink(tmpname)
+        except (OSError, IOError):
+            return False  # Evicted in the meantime, perhaps
+        with conn:
+            conn.execute('UPDATE artifacts SET last_used = ? WHERE key = ?',
+                         (time.time(), key))
+        return True
+
+    def store(self, key, filenames):
+        """Add copies of 'filenames' under 'key'.
+
+        Returns False (and stores nothing) if any is not a regular file.
+        """
+        filenames = [str(fn) for fn in filenames]
+        if not all(os.path.isfile(fn) for fn in filenames):
+            return False
+        entry = self._entry_dir(key)
+        if entry.isdir():
+            return True  # Someone beat us to it
+        entry.dirname().makedirs_p()
+        tmpdir = tempfile.mkdtemp(prefix='._tmp', dir=str(self.root))
+        try:
+            size, inodes = 0, []
+            for i, fn in enumerate(filenames):
+                dst = os.path.join(tmpdir, str(i))
+                _clone(fn, dst)
+                os.chmod(dst, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                st = os.stat(dst)
+                size += st.st_size
+                inodes.append((key, st.st_dev, st.st_ino))
+            try:
+                os.rename(tmpdir, entry)
+            except OSError:
+                return True  # Appeared in the meantime
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)',
+                         (key, size, time.time()))
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', inodes)
+        self._evict()
+        return True
+
+    def total_bytes(self):
+        """Total size of the cached outputs."""
+        row = self._connect().execute('SELECT SUM(size) FROM artifacts').fetchone()
+        return row[0] or 0
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        conn = self._connect()
+        rows = conn.execute('SELECT key, size FROM artifacts '
+                            'ORDER BY last_used DESC').fetchall()
+        total = 0
+        for key, size in rows:
+            total += size
+            if total > self.max_bytes:
+                self.discard(key)
+
+    def discard(self, key):
+        """Remove the entry for 'key', if there is one."""
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM artifacts WHERE key = ?', (key,))
+            conn.execute('DELETE FROM files WHERE key = ?', (key,))
+        entry = self._entry_dir(key)
+        if entry.isdir():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self):
+        """Remove all entries."""
+        for (key,) in self._connect().execute('SELECT key FROM artifacts').fetchall():
+            self.discard(key)
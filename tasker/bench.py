@@ -0,0 +1,246 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Benchmarks for choosing storage formats.
+
+Run from the command line, e.g.
+
+    python -m tasker.bench storage                  # Built-in samples
+    python -m tasker.bench storage --task DIR NAME  # Outputs of a task
+    python -m tasker.bench storage --json           # Machine-readable
+
+See bench_storage() for what is measured.
+"""
+import six
+import os, sys, time
+import json
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+from collections import OrderedDict
+
+from . import storage
+from .storage import is_stream
+
+# Format name -> function of filename that makes a FileBase instance
+FORMATS = OrderedDict([
+    ('JSON', lambda fn: storage.JSON(fn + '.json')),
+    ('JSON-compact', lambda fn: storage.JSON(fn + '.json', compact=True)),
+    ('JSONLines', lambda fn: storage.JSONLines(fn + '.jsonl')),
+    ('Pickle', lambda fn: storage.Pickle(fn + '.pickle')),
+    ('Pickle-gzip', lambda fn: storage.Pickle(fn + '.pickle', compression='gzip')),
+    ('Pandas', lambda fn: storage.Pandas(fn + '.h5')),
+    ('NumPy', lambda fn: storage.NumPy(fn + '.npy', mmap_mode=None)),
+    ('Parquet', lambda fn: storage.Parquet(fn + '.parquet')),
+    ])
+
+COLUMNS = ['object', 'format', 'ok', 'roundtrip', 'save_s', 'read_s', 'bytes',
+           'save_MBps', 'read_MBps', 'save_peak_bytes', 'read_peak_bytes', 'error']
+
+
+def sample_objects(n=100000):
+    """Representative data: a list of records, a DataFrame, and an array."""
+    import numpy, pandas
+    rng = numpy.random.RandomState(0)
+    frame = pandas.DataFrame({'frame': numpy.arange(n) // 100,
+                              'x': rng.random_sample(n), 'y': rng.random_sample(n)})
+    return OrderedDict([
+        ('records', [{'frame': int(i), 'event': 'e%i' % (i % 7), 'value': float(v)}
+                     for i, v in zip(range(n // 10), rng.random_sample(n // 10))]),
+        ('frame', frame),
+        ('array', rng.random_sample((n // 100, 100))),
+        ])
+
+
+def task_objects(dirname, taskname):
+    """The outputs of a task that are stored in recognized formats, by filename."""
+    from .loader import use
+    tsk = use(dirname).tasks[taskname]
+    return OrderedDict((os.path.basename(fo.filename), fo.read())
+                       for fo in tsk.outs if isinstance(fo, storage.FileBase))
+
+
+def _same(a, b):
+    """True if 'b' is a faithful copy of 'a'."""
+    import numpy
+    try:
+        if hasattr(a, 'equals'):  # Pandas
+            return type(a) is type(b) and a.equals(b)
+        elif isinstance(a, numpy.ndarray):
+            return isinstance(b, numpy.ndarray) and numpy.array_equal(a, b)
+        return type(a) is type(b) and a == b
+    except Exception:
+        return False
+
+
+def _run(fcn):
+    result = fcn()
+    if is_stream(result):
+        result = list(result)
+    return result
+
+
+def _timed(fcn):
+    """Run 'fcn'. Returns (result, seconds)."""
+    start = time.perf_counter()
+    result = _run(fcn)
+    return result, time.perf_counter() - start
+
+
+def _peak_memory(fcn):
+    """Run 'fcn'. Returns (result, peak bytes allocated by Python).
+
+    Tracing slows down every allocation, so this is kept apart from timing.
+    """
+    tracemalloc.start()
+    try:
+        result = _run(fcn)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def bench_storage(objects, formats=None, repeat=3, tmpdir=None):
+    """Measure the cost of saving and reading 'objects' in each format.
+
+    'objects' maps names to data. 'formats' is a list of names from FORMATS
+    (default: all). Each save and read is timed 'repeat' times, and the best
+    time is kept. Peak memory is what Python allocated during one more save
+    and read, made separately because tracing allocations slows them down.
+
+    Returns a DataFrame with one row per object and format, with columns
+    listed in COLUMNS. Throughputs are in megabytes (of file) per second.
+    Formats that cannot store an object (or whose libraries are missing) have
+    'ok' False, and the reason in 'error'. 'roundtrip' is False where what is
+    read back differs from the original (e.g. in type).
+    """
+    import pandas
+    if formats is None:
+        formats = list(FORMATS)
+    workdir = tempfile.mkdtemp(prefix='tasker-bench', dir=tmpdir)
+    rows = []
+    try:
+        for objname, data in objects.items():
+            for fmtname in formats:
+                row = dict(object=objname, format=fmtname, ok=False, error='')
+                fo = FORMATS[fmtname](os.path.join(workdir, 'bench'))
+                try:
+                    _, row['save_peak_bytes'] = _peak_memory(lambda: fo.save(data))
+                    _, row['read_peak_bytes'] = _peak_memory(fo.read)
+                    times = {'save': [], 'read': []}
+                    for i in range(repeat):
+                        _, elapsed = _timed(lambda: fo.save(data))
+                        times['save'].append(elapsed)
+                        bounced, elapsed = _timed(fo.read)
+                        times['read'].append(elapsed)
+                        if i == 0:
+                            row['roundtrip'] = _same(data, bounced)
+                        del bounced
+                    row['bytes'] = os.path.getsize(fo.filepath)
+                    for op in ('save', 'read'):
+                        best = min(times[op])
+                        row[op + '_s'] = best
+                        row[op + '_MBps'] = row['bytes'] / 1e6 / best if best else None
+                    row['ok'] = True
+                except Exception as e:
+                    row['error'] = '%s: %s' % (type(e).__name__, e)
+                finally:
+                    if os.path.exists(fo.filepath):
+                        os.unlink(fo.filepath)
+                rows.append(row)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return pandas.DataFrame(rows, columns=COLUMNS)
+
+
+def recommend(results):
+    """For each object, the formats that read fastest, save fastest, and are smallest.
+
+    Only formats that reproduce the object faithfully are considered.
+    """
+    recs = OrderedDict()
+    ok = results[results.ok & (results.roundtrip == True)]
+    for objname in results.object.unique():
+        r = ok[ok.object == objname]
+        if not len(r):
+            recs[objname] = None
+            continue
+        recs[objname] = dict(
+            fastest_read=r.format[r.read_s.idxmin()],
+            fastest_save=r.format[r.save_s.idxmin()],
+            smallest=r.format[r.bytes.idxmin()])
+    return recs
+
+
+def summary(results):
+    """Machine-readable summary of bench_storage() results, as a dict."""
+    import numpy
+    def clean(v):  # numpy and NaN values -> JSON
+        if isinstance(v, numpy.generic):
+            v = v.item()
+        if isinstance(v, float) and v != v:
+            return None
+        return v
+    return dict(
+        benchmark='storage',
+        python=sys.version.split()[0],
+        results=[dict((k, clean(v)) for k, v in row.items())
+                 for row in results.to_dict('records')],
+        recommendations=recommend(results),
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tasker.bench',
+                                     description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='benchmark')
+    p = sub.add_parser('storage', help='save/read cost of each storage format')
+    p.add_argument('--task', nargs=2, metavar=('DIR', 'TASK'),
+                   help='use the stored outputs of this task instead of samples')
+    p.add_argument('--size', type=int, default=100000,
+                   help='number of rows in sample objects')
+    p.add_argument('--formats', nargs='+', choices=list(FORMATS),
+                   help='formats to try (default: all)')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--tmpdir', help='where to write files (default: system temp)')
+    p.add_argument('--json', action='store_true',
+                   help='print results as JSON instead of a table')
+    args = parser.parse_args(argv)
+    if args.benchmark != 'storage':
+        parser.print_help()
+        return 2
+    if args.task:
+        objects = task_objects(*args.task)
+    else:
+        objects = sample_objects(args.size)
+    results = bench_storage(objects, args.formats, args.repeat, args.tmpdir)
+    if args.json:
+        json.dump(summary(results), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        six.print_(results.drop(columns=['error']).to_string(index=False))
+        for objname, rec in recommend(results).items():
+            if rec is None:
+                six.print_('%s: no format could store it faithfully' % objname)
+            else:
+                six.print_('%s: fastest read %s, fastest save %s, smallest %s'
+                           % (objname, rec['fastest_read'], rec['fastest_save'],
+                              rec['smallest']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""In-memory cache of data read from task files."""
+import six
+import os
+import threading
+from collections import OrderedDict
+
+from .storage import is_stream
+
+
+class ReadCache(object):
+    """Least-recently-used cache of the contents of FileBase instances.
+
+    Entries are found by the file's identity (format, path, and e.g. the key
+    within a Pandas file), and are only used if the file's modification time
+    and size have not changed since it was read. The cost of an entry is
+    taken to be the size of the file on disk; the least recently used
+    entries are dropped to keep the total under 'max_bytes'.
+
+    'max_bytes' of 0 disables the cache.
+
+    Cached objects are shared by everyone who reads them, and must not
+    be modified.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # identity -> (signature, cost, data)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def read(self, fileobj):
+        """Return the contents of 'fileobj', from the cache if possible."""
+        if not self.max_bytes:
+            return fileobj.read()
+        try:
+            st = os.stat(str(fileobj.filepath))
+        except OSError:
+            return fileobj.read()  # Let the file format report the problem
+        ident = fileobj._identity()
+        signature = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(ident)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(ident)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        data = fileobj.read()
+        if not is_stream(data):  # Iterators can only be consumed once
+            self.put(fileobj, data, signature)
+        return data
+
+    def put(self, fileobj, data, signature=None):
+        """Store 'data' as the contents of 'fileobj'.
+
+        'signature' is (mtime_ns, size) of the file; if not given, it is
+        looked up.
+        """
+        if signature is None:
+            try:
+                st = os.stat(str(fileobj.filepath))
+            except OSError:
+                return
+            signature = (st.st_mtime_ns, st.st_size)
+        cost = signature[1]
+        ident = fileobj._identity()
+        with self._lock:
+            self._remove(ident)
+            if not self.max_bytes or cost > self.max_bytes:
+                return
+            self._entries[ident] = (signature, cost, data)
+            self._total += cost
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Change the budget, dropping entries if necessary."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def discard(self, filepath):
+        """Forget everything read from 'filepath' (e.g. because it is being rewritten)."""
+        filepath = str(filepath)
+        with self._lock:
+            for ident in [i for i in self._entries if i[1] == filepath]:
+                self._remove(ident)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+    def _evict(self):
+        while self._total > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, ident):
+        entry = self._entries.pop(ident, None)
+        if entry is not None:
+            self._total -= entry[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+read_cache = ReadCache()  # Shared by all tasks in this process
+
+
+def set_read_cache(max_bytes):
+    """Cache data read by tasks in memory, up to roughly 'max_bytes' in total.
+
+    The budget is measured in bytes of file on disk. 0 turns off the cache
+    (the default).
+    """
+    read_cache.resize(max_bytes)
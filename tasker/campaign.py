@@ -0,0 +1,144 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Running a task in many directories at once."""
+import six
+import os, time
+import traceback
+import multiprocessing, multiprocessing.pool
+import pandas
+from path import Path
+
+from .loader import use
+from .storage import HDFPool, hdf_pool, _hdf_local
+from .accounting import read_runs, summarize
+from .trace import TraceRecorder
+
+
+def _run_unit(unit):
+    """Bring one task up to date in one directory.
+
+    Runs in a worker. Returns a dict describing the outcome; exceptions are
+    reported there rather than raised, so one bad directory cannot stop
+    the others.
+    """
+    dirname, taskname, threads, use_kw, trace = unit
+    info = {'dir': os.path.basename(dirname), 'absdir': dirname,
+            'task': taskname, 'error': ''}
+    start = time.time()
+    recorder = TraceRecorder() if trace else None
+    try:
+        tsk = use(dirname, **use_kw).tasks[taskname]
+        if threads and tsk.tasker.chdir:
+            raise ValueError('Tasker for "%s" must have chdir=False to run in '
+                             'a thread.' % dirname)
+        if recorder is not None:
+            recorder.attach(tsk)
+        if not tsk.report():
+            info['outcome'] = 'current'
+        else:
+            tsk.sync()
+            info['outcome'] = 'done'
+    except Exception:
+        info['outcome'] = 'error'
+        info['error'] = traceback.format_exc()
+    finally:
+        if recorder is not None:
+            recorder.detach()
+            info['trace_events'] = recorder.events
+    info['elapsed'] = time.time() - start
+    return info
+
+
+def _open_hdf_pool(pools):
+    """Worker initializer: reuse HDFStore handles for the worker's lifetime."""
+    pool = _hdf_local.pool = HDFPool()
+    pools.append(pool)
+
+
+def run_campaign(dirs, taskname, workers=None, threads=False, trace=None, **kw):
+    """Bring task 'taskname' up to date in each of 'dirs', in parallel.
+
+    Each directory is loaded with use(directory, **kw) inside a worker
+    process, so nothing needs to be pickled but the names. Directories are
+    handed out one at a time as workers become free.
+
+    workers : number of worker processes (default: number of CPUs). If 1,
+        directories are processed in turn, in this process.
+    threads : if true, use a pool of threads instead of processes. The
+        taskers must be created with chdir=False.
+
+    Each worker keeps recently used HDFStore handles open for reuse (see
+    storage.HDFPool) until the campaign is over.
+
+    trace : if given, a filename to which a timeline of every step of every
+        task, in every worker, is saved (see tasker.trace).
+
+    Returns a DataFrame with one row per directory, in the order given.
+    'outcome' is "current" if nothing needed to be done, "done" if the task
+    (or anything upstream of it) was run, or "error", in which case the
+    traceback is in the 'error' column. 'elapsed' is in seconds.
+    """
+    units = [(str(Path(d).abspath()), taskname, threads, kw, bool(trace))
+             for d in dirs]
+    if workers == 1:
+        with hdf_pool():
+            results = [_run_unit(u) for u in units]
+    else:
+        hdf_pools = []  # Filled by threads. Read-only handles in processes die with them.
+        if threads:
+            pool = multiprocessing.pool.ThreadPool(workers, _open_hdf_pool,
+                                                   (hdf_pools,))
+        else:
+            pool = multiprocessing.Pool(workers, _open_hdf_pool, (hdf_pools,))
+        try:
+            results = list(pool.imap_unordered(_run_unit, units, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+            for hp in hdf_pools:
+                hp.close()
+        order = dict((u[0], i) for i, u in enumerate(units))
+        results.sort(key=lambda r: order[r['absdir']])
+    if trace:
+        recorder = TraceRecorder()
+        for r in results:
+            recorder.extend(r.pop('trace_events'))
+        recorder.save(trace)
+    return pandas.DataFrame(results, columns=['dir', 'absdir', 'task', 'outcome',
+                                              'elapsed', 'error'])
+
+
+def run_history(dirs):
+    """Recorded task runs in all of 'dirs' (see the Tasker's 'record_runs').
+
+    Returns a DataFrame like accounting.read_runs(), with 'dir' and 'absdir'
+    columns added.
+    """
+    histories = []
+    for d in dirs:
+        runs = read_runs(d)
+        runs.insert(0, 'absdir', str(Path(d).abspath()))
+        runs.insert(0, 'dir', os.path.basename(d))
+        histories.append(runs)
+    return pandas.concat(histories, ignore_index=True)
+
+
+def profile_campaign(dirs, by='task'):
+    """Summary of recorded task runs across 'dirs', most expensive first.
+
+    'by' is the column (or list of columns) to group by, e.g. ['dir', 'task'].
+    See accounting.summarize() for the columns.
+    """
+    return summarize(run_history(dirs), by)
@@ -13,6 +13,7 @@
 #   limitations under the License.
 import six
 import sys
+import threading
 
 # Whether to hide implementation details in tracebacks
 EDIT_TRACEBACKS = True
@@ -33,7 +34,15 @@ class tasker_traceback(object):
         self.name = name
         self.cwd = cwd
 
-    _tasker_stack = []  # Class attribute
+    _local = threading.local()  # Class attribute; one stack per thread
+
+    @property
+    def _tasker_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
 
     def __enter__(self):
         if self.name:
@@ -0,0 +1,85 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Batched, cached file metadata for status checks."""
+import six
+import os
+import errno
+
+
+class StatCache(object):
+    """os.stat() results for many files, gathered a directory at a time.
+
+    prefetch() groups files by parent directory, and lists each directory
+    once with os.scandir(). Missing files are found from the listing rather
+    than by failed calls to stat(), and on network filesystems the listing
+    also primes the client's attribute cache. Results are kept until
+    forget() is called, so each file is examined at most once.
+
+    Directories from which fewer than 'min_batch' files are wanted are not
+    listed; those files are stat()ed individually, on demand.
+    """
+    def __init__(self, min_batch=4):
+        self.min_batch = min_batch
+        self._stats = {}  # filename -> os.stat_result, or None if missing
+
+    def prefetch(self, filenames):
+        """Gather information about 'filenames' in as few passes as possible."""
+        bydir = {}
+        for fn in map(str, filenames):
+            if fn not in self._stats:
+                bydir.setdefault(os.path.dirname(fn), set()).add(os.path.basename(fn))
+        for dirname, names in bydir.items():
+            if len(names) < self.min_batch:
+                continue
+            try:
+                entries = os.scandir(dirname)
+            except OSError:
+                entries = None  # Directory is missing, so the files are too
+            if entries is not None:
+                with entries:
+                    for entry in entries:
+                        if entry.name in names:
+                            try:
+                                self._stats[entry.path] = entry.stat()
+                            except OSError:  # Broken symlink, or just deleted
+                                self._stats[entry.path] = None
+                            names.discard(entry.name)
+            for name in names:
+                self._stats[os.path.join(dirname, name)] = None
+
+    def stat(self, filename):
+        """os.stat_result for 'filename', or None if it does not exist."""
+        filename = str(filename)
+        try:
+            return self._stats[filename]
+        except KeyError:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                st = None
+            self._stats[filename] = st
+            return st
+
+    def mtime(self, filename):
+        """Modification time of 'filename'. Raises OSError if it is missing."""
+        st = self.stat(filename)
+        if st is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), str(filename))
+        return st.st_mtime
+
+    def forget(self, filenames):
+        """Discard information about files that may have changed."""
+        for fn in map(str, filenames):
+            self._stats.pop(fn, None)
@@ -16,6 +16,9 @@
 import six
 import os, json, time, datetime
 import signal
+import warnings
+import threading
+from concurrent import futures
 import numpy as np
 import pandas
 
@@ -23,28 +26,112 @@ DEFAULT_STATUS_FILE = '.taskerstatus.json'
 DEFAULT_STATUS_DIR = '.taskerlocks'
 
 class Monitor(object):
-    """Monitor workers in many directories."""
-    def __init__(self, dirs, filename=DEFAULT_STATUS_FILE):
+    """Monitor workers in many directories.
+
+    Status files are examined with 'workers' threads at once. Between
+    refreshes, the Monitor remembers each file's identity, size and
+    modification time, and only re-reads the files that have changed.
+
+    If 'store' is given (see tasker.statusdb), statuses are instead read
+    from there in a single query, and status files are not touched.
+    """
+    def __init__(self, dirs, filename=DEFAULT_STATUS_FILE, workers=16, store=None):
         self.dirs = dirs
         self.filename = filename
+        self.workers = workers
+        self.store = store
+        self._reset()
+    def _reset(self):
+        self._dirs = list(self.dirs)
+        n = len(self._dirs)
+        self._signatures = [None] * n  # (ino, mtime_ns, size), or None if missing
+        self._mtimes = np.full(n, np.nan)
+        self._keycounts = {}  # Column -> number of rows with a value for it
+        self._rowkeys = [()] * n
+        self._table = pandas.DataFrame(
+            {'dir': [os.path.basename(d) for d in self._dirs],
+             'absdir': [os.path.abspath(d) for d in self._dirs],
+             'status': ['?'] * n, 'since_update': [''] * n},
+            columns=['dir', 'absdir', 'status', 'since_update'], dtype=object)
+        self._checked = False
+    def _check(self, i):
+        """Look at status file for directory number 'i'.
+
+        Returns None if it is unchanged, otherwise (signature, mtime, info).
+        """
+        sfn = os.path.join(self._dirs[i], self.filename)
+        try:
+            st = os.stat(sfn)
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            signature = None
+        if self._checked and signature == self._signatures[i]:
+            return None
+        info = {'status': '?'}
+        if signature is not None:
+            try:
+                with open(sfn, 'r') as sf:
+                    info = json.load(sf)
+            except IOError:  # Gone in the meantime
+                signature = None
+            except ValueError:  # Corrupt; don't try again until it changes
+                pass
+        return signature, (st.st_mtime if signature else np.nan), info
+    def _check_store(self):
+        """Like _check(), for all directories at once, from the status store."""
+        absdirs = list(self._table.absdir)
+        latest = self.store.latest(absdirs)
+        results = []
+        for i, absdir in enumerate(absdirs):
+            updated, info = latest.get(absdir, (None, {'status': '?'}))
+            if self._checked and updated == self._signatures[i]:
+                results.append(None)
+            else:
+                results.append((updated, np.nan if updated is None else updated, info))
+        return results
     def get_statuses(self):
         """Returns DataFrame of status info for a list of filenames"""
-        info = []
-        for d in self.dirs:
-            try:
-                sfn = os.path.join(d, self.filename)
-                sf = open(sfn, 'r')
-                sfinfo = json.load(sf)
-                sfinfo['dir'] = os.path.basename(d)
-                sfinfo['absdir'] = os.path.abspath(d)
-                sfinfo['since_update'] = _format_td(datetime.timedelta(0,
-                    time.time() - os.path.getmtime(sfn)))
-            except IOError:
-                sfinfo = {'dir': os.path.basename(d), 
-                        'absdir': os.path.abspath(d),
-                        'status': '?'}
-            info.append(sfinfo)
-        return pandas.DataFrame(info).astype(object).fillna('') # Blanks, not NaNs
+        if list(self.dirs) != self._dirs:
+            self._reset()
+        n = len(self._dirs)
+        if self.store is not None:
+            results = self._check_store()
+        elif self.workers > 1 and n > 1:
+            with futures.ThreadPoolExecutor(min(self.workers, n)) as pool:
+                results = list(pool.map(self._check, range(n)))
+        else:
+            results = [self._check(i) for i in range(n)]
+        table = self._table
+        for i, res in enumerate(results):
+            if res is not None:
+                self._signatures[i], self._mtimes[i], info = res
+                self._set_row(i, info)
+        self._checked = True
+        now = time.time()
+        table['since_update'] = [
+            '' if np.isnan(mt) else _format_td(datetime.timedelta(0, now - mt))
+            for mt in self._mtimes]
+        return table.copy()
+    def _set_row(self, i, info):
+        """Replace the status information in row 'i' of the table."""
+        table = self._table
+        info = dict((k, v) for k, v in info.items()
+                    if k not in ('dir', 'absdir', 'since_update'))
+        for k in self._rowkeys[i]:
+            if k != 'status':
+                table.at[i, k] = ''
+                self._keycounts[k] -= 1
+                if not self._keycounts[k]:  # Nobody reports this any more
+                    del table[k], self._keycounts[k]
+        for k, v in info.items():
+            if k not in table:
+                table[k] = pandas.Series('', index=table.index, dtype=object)
+            if k != 'status':
+                self._keycounts[k] = self._keycounts.get(k, 0) + 1
+            table.at[i, k] = v
+        if 'status' not in info:
+            table.at[i, 'status'] = ''
+        self._rowkeys[i] = tuple(info)
     def show(self, custom_columns=None):
         """Presents formatted status info.
 
@@ -89,19 +176,108 @@ class Monitor(object):
 
 class StatusFile(object):
     """JSON-formatted file for status of a long-running computation"""
-    def __init__(self, persistent_info=None, filename=DEFAULT_STATUS_FILE):
+    def __init__(self, persistent_info=None, filename=DEFAULT_STATUS_FILE,
+                 interval=0, background=False, store=None):
         """'persistent_info' is a dict that will be included
         in every update.
+
+        'interval' : report() writes the file at most once in this many
+            seconds. update() always writes it at once.
+        'background' : if true, report() leaves the writing to a thread,
+            so that the caller never waits for the filesystem.
+        'store' : central status store (see tasker.statusdb) that also
+            receives every update, under this file's directory.
         """
+        self.store = store
         self.filename = filename
         if persistent_info is None:
             self.persistent_info = {}
         else:
             self.persistent_info = persistent_info.copy()
         self.persistent_info['pid'] = os.getpid()
+        self.interval = interval
+        self.background = background
+        self._last_write = 0
+        self._pending = None  # Newest info not yet written by report()
+        self._seq = 0  # Counts update()s, which supersede pending reports
+        self._lock = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._error = None  # Raised in the background writer, for the caller
     def update(self, newinfo):
         """Write status file with 'newinfo', including persistent information."""
-        tmpname = self.filename + '._tmp'
+        with self._lock:
+            self._pending = None
+            self._seq += 1
+        with self._write_lock:
+            self._write(newinfo)
+    def report(self, newinfo):
+        """Like update(), for frequent progress reports.
+
+        Writes are coalesced according to 'interval', and done on a thread
+        if 'background' is set. Reports that are not written are replaced
+        by newer ones, or written by flush(). If the background writer has
+        failed, its error is raised here (or by close()).
+        """
+        self._raise_error()
+        with self._lock:
+            self._pending = newinfo
+            if self.interval and time.time() - self._last_write < self.interval:
+                return
+            if self.background:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._write_loop,
+                                                    name='tasker-status')
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._lock.notify()
+                return
+        self.flush()
+    def flush(self):
+        """Write any report that is still pending."""
+        with self._lock:
+            info, self._pending = self._pending, None
+            seq = self._seq
+        if info is not None:
+            self._write_report(info, seq)
+    def close(self):
+        """Stop the background writer (if any), discarding pending reports."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._pending = None
+            self._lock.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._raise_error()
+    def _raise_error(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+    def _write_loop(self):
+        me = threading.current_thread()
+        while True:
+            with self._lock:
+                while self._thread is me and self._pending is None:
+                    self._lock.wait()
+                if self._thread is not me:
+                    return
+                info, self._pending = self._pending, None
+                seq = self._seq
+            try:
+                self._write_report(info, seq)
+            except Exception as e:  # Keep trying, but tell the caller
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+    def _write_report(self, info, seq):
+        with self._write_lock:
+            if seq == self._seq:  # Not since superseded by update()
+                self._write(info)
+    def _write(self, newinfo):
+        # Unique, in case other threads or processes report to the same file
+        tmpname = '%s.%i-%i._tmp' % (self.filename, os.getpid(),
+                                      threading.current_thread().ident)
         tmpfile = open(tmpname, 'w')
         info = self.persistent_info.copy()
         info.update(newinfo)
@@ -110,6 +286,13 @@ class StatusFile(object):
         if os.name == 'nt':
             os.unlink(self.filename) # Windows doesn't allow overwriting existing file
         os.rename(tmpname, self.filename)
+        self._last_write = time.time()
+        if self.store is not None:
+            try:
+                self.store.put(os.path.dirname(os.path.abspath(self.filename)),
+                               info, self._last_write)
+            except Exception as e:  # Must not stop the work being reported
+                warnings.warn('Could not report status to %r: %r' % (self.store, e))
 
 class Stopwatch(object):
     """Keeps track of execution time"""
@@ -117,10 +300,20 @@ class Stopwatch(object):
         """Start the stopwatch"""
         self.timestamp_start = datetime.datetime.now()
         self.started = self.timestamp_start.strftime('%c')
-        self.laptimes = []
+        self.laps = 0  # Number of laps completed
+        self.last_lap = None  # When the last one was completed
+    @property
+    def laptimes(self):
+        """Read-only view of the lap times, for compatibility.
+
+        Only its length and the last lap time are kept; use 'laps' and
+        'last_lap' instead.
+        """
+        return _LapTimes(self)
     def lap(self):
         """Mark completion of a lap (or cycle, etc.)"""
-        self.laptimes.append(datetime.datetime.now())
+        self.laps += 1
+        self.last_lap = datetime.datetime.now()
     def elapsed(self):
         """Returns datetime.timedelta instance of time since start.
         
@@ -129,10 +322,10 @@ class Stopwatch(object):
         return datetime.datetime.now() - self.timestamp_start
     def mean_lap_time(self):
         """Mean time, in seconds, between laps"""
-        if not self.laptimes:
+        if not self.laps:
             return np.nan
-        return (self.laptimes[-1] - self.timestamp_start).total_seconds() \
-                / float(len(self.laptimes))
+        return (self.last_lap - self.timestamp_start).total_seconds() \
+                / float(self.laps)
     def estimate_completion(self, total_laps, laps=None):
         """Estimate how much time is left until completion.
 
@@ -142,13 +335,29 @@ class Stopwatch(object):
         Returns 'None' if time would be negative.
         """
         if laps is None:
-            laps = len(self.laptimes)
+            laps = self.laps
         if laps > total_laps or laps == 0:
             return None
         else:
             return datetime.timedelta(0, self.elapsed().total_seconds() \
                                          / laps * (total_laps - laps))
 
+class _LapTimes(object):
+    """Stand-in for the list of lap times that Stopwatch used to keep."""
+    def __init__(self, stopwatch):
+        self._sw = stopwatch
+    def __len__(self):
+        return self._sw.laps
+    def __getitem__(self, i):
+        n = self._sw.laps
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('lap index out of range')
+        if i != n - 1:
+            raise IndexError('Stopwatch only keeps the time of the last lap')
+        return self._sw.last_lap
+
 def _format_td(timedelt):
     """Format a timedelta object as hh:mm:ss"""
     if timedelt is None:
@@ -161,11 +370,18 @@ def _format_td(timedelt):
 
 class Progress(StatusFile):
     def __init__(self, persistent_info=None,
-                 filename=DEFAULT_STATUS_FILE):
+                 filename=DEFAULT_STATUS_FILE, interval=0, background=False,
+                 store=None):
         """persistent_info : dict of information to always report
+
+        'interval' and 'background' control how often, and where, progress
+        reports from working() and tally() are written (see StatusFile).
+        Changes of status are always written at once. 'store' is an optional
+        central status store.
         """
         super(Progress, self).__init__(persistent_info=persistent_info,
-                                       filename=filename)
+                                       filename=filename, interval=interval,
+                                       background=background, store=store)
         self.total_parts = None
         self.stopwatch = Stopwatch()
         self.total = None # total units of work, if we ever find out
@@ -178,9 +394,15 @@ class Progress(StatusFile):
         tasker's locking mechanism, which keeps multiple taskers from
         working in the same directory.
         """
+        super(Progress, self).update(self._timed(newinfo))
+
+    def report(self, newinfo):
+        super(Progress, self).report(self._timed(newinfo))
+
+    def _timed(self, newinfo):
         newinfo.update({'started': self.stopwatch.started,
                         'elapsed_time': _format_td(self.stopwatch.elapsed())})
-        super(Progress, self).update(newinfo)
+        return newinfo
 
     def working(self, current=None, total=None, info=None):
         """Report progress on a task.
@@ -201,7 +423,10 @@ class Progress(StatusFile):
                 self.stopwatch.estimate_completion(total, current))
         if info is not None:
             tmpinfo.update(info)
-        self.update(tmpinfo)
+        if current is None:
+            self.update(tmpinfo)
+        else:
+            self.report(tmpinfo)
 
     def tally(self, iterable, total=None, info=None):
         """Pass-through generator that tracks progress.
@@ -215,16 +440,16 @@ class Progress(StatusFile):
         for frame in tally(frames, len(frames)):
             do_something_with(frame)
         """
+        if total is None:
+            try:
+                total = len(iterable)
+            except TypeError:
+                total = None
         for i, item in enumerate(iterable):
             self.stopwatch.lap()
             tmpinfo = {'status': 'working',
                 'current': i + 1,
                 'time_per': self.stopwatch.mean_lap_time()}
-            if total is None:
-                try:
-                    total = len(iterable)
-                except TypeError:
-                    total = None
             if total is not None:
                 self.total = total
                 tmpinfo['total'] = total
@@ -233,8 +458,9 @@ class Progress(StatusFile):
                         self.stopwatch.estimate_completion(total))
             if info is not None:
                 tmpinfo.update(info)
-            self.update(tmpinfo)
+            self.report(tmpinfo)
             yield item
+        self.flush()  # The final count
 
     def _finish(self, info=None):
         """Signal end of task.
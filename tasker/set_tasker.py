@@ -20,6 +20,7 @@ from .base import cachedprop
 from .task import Tasker
 from .storage import JSON
 from .loader import use
+from .campaign import run_campaign
 
 class SetTasker(Tasker):
     """Tasker with convenient methods for handling taskers in subdirectories"""
@@ -43,6 +44,14 @@ class SetTasker(Tasker):
         """use() each directory in a named group"""
         return [use(self.p / dirname, **kw) for dirname in self.groups[groupname]]
 
+    def run_group(self, groupname, taskname, workers=None, threads=False, **kw):
+        """Bring a task up to date in each directory of a named group, in parallel.
+
+        Returns a DataFrame of outcomes. See run_campaign() for details.
+        """
+        return run_campaign([self.p / dirname for dirname in self.groups[groupname]],
+                            taskname, workers=workers, threads=threads, **kw)
+
     @cachedprop
     def aliases(self):
         """Dictionary of aliases to relative paths of subdirectories."""
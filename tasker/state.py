@@ -0,0 +1,182 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Persistent, per-directory record of what tasker knows about its files."""
+import six
+import os
+import stat
+import json
+import hashlib
+import sqlite3
+import threading
+
+DEFAULT_STATE_FILE = '.taskerstate.sqlite'
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS file_digests (
+        path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+        digest TEXT)""",
+    """CREATE TABLE IF NOT EXISTS task_inputs (
+        task TEXT PRIMARY KEY, digest TEXT)""",
+    """CREATE TABLE IF NOT EXISTS task_status (
+        task TEXT PRIMARY KEY, key TEXT, files TEXT, done INTEGER,
+        needed TEXT)""",
+    """CREATE TABLE IF NOT EXISTS task_runs (
+        task TEXT PRIMARY KEY, finished REAL)""",
+    ]
+
+
+def stat_signature(st):
+    """(mtime_ns, size) from an os.stat_result, or None if 'st' is None."""
+    if st is None:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _hash_file(filename, blocksize=1 << 20):
+    """Hex digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class BuildState(object):
+    """SQLite database of file signatures and task status.
+
+    Content hashes are cached under the file's (inode, size, mtime_ns), so
+    a file is only re-read when one of those changes.
+
+    Task status records remember whether a task was current, along with the
+    stat_signature() of every file it and its upstream tasks use; while none
+    of those files change, the status still holds.
+
+    The database is opened lazily by each thread that uses it, and
+    re-opened after a fork().
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.filename), timeout=60)
+            with conn:
+                for stmt in _SCHEMA:
+                    conn.execute(stmt)
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def close(self):
+        """Close this thread's connection to the database."""
+        local = self._local
+        if getattr(local, 'conn', None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
+
+    def file_digest(self, filename, st=None):
+        """Signature of the contents of 'filename'.
+
+        'st' is the result of os.stat(), if already known.
+
+        Directories are represented by their size and modification time.
+        Raises OSError if the file does not exist.
+        """
+        filename = str(filename)
+        if st is None:
+            st = os.stat(filename)
+        if stat.S_ISDIR(st.st_mode):
+            return 'dir:%i:%i' % (st.st_size, st.st_mtime_ns)
+        conn = self._connect()
+        row = conn.execute('SELECT ino, size, mtime_ns, digest FROM file_digests '
+                           'WHERE path = ?', (filename,)).fetchone()
+        if row is not None and tuple(row[:3]) == \
+                (st.st_ino, st.st_size, st.st_mtime_ns):
+            return row[3]
+        digest = _hash_file(filename)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?, ?)',
+                         (filename, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def files_digest(self, filenames, stats=None):
+        """Combined signature of several files. Missing files are allowed.
+
+        'stats' is a StatCache to consult (optional).
+        """
+        h = hashlib.sha1()
+        for fn in sorted(set(str(f) for f in filenames)):
+            try:
+                if stats is None:
+                    digest = self.file_digest(fn)
+                else:
+                    st = stats.stat(fn)
+                    digest = 'missing' if st is None else self.file_digest(fn, st)
+            except OSError:
+                digest = 'missing'
+            h.update(('%s\0%s\0' % (fn, digest)).encode('utf-8'))
+        return h.hexdigest()
+
+    def task_digest(self, taskname):
+        """Input signature recorded at task's last successful run, or None."""
+        row = self._connect().execute('SELECT digest FROM task_inputs WHERE task = ?',
+                                      (taskname,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_task_digest(self, taskname, digest):
+        """Record input signature for a task. 'digest' of None forgets it."""
+        conn = self._connect()
+        with conn:
+            if digest is None:
+                conn.execute('DELETE FROM task_inputs WHERE task = ?', (taskname,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO task_inputs VALUES (?, ?)',
+                             (taskname, digest))
+
+    def task_status(self, taskname):
+        """Recorded (key, files, done, needed) for a task, or None.
+
+        'files' maps filenames to stat_signature(); 'needed' is a list of
+        [directory, taskname] pairs.
+        """
+        row = self._connect().execute('SELECT key, files, done, needed '
+                'FROM task_status WHERE task = ?', (taskname,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), bool(row[2]), json.loads(row[3])
+
+    def set_task_status(self, taskname, key, files, done, needed):
+        """Record status of a task. See task_status()."""
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO task_status VALUES (?, ?, ?, ?, ?)',
+                         (taskname, key, json.dumps(files), int(done),
+                          json.dumps(needed)))
+
+    def last_run(self, taskname):
+        """time.time() when task last finished running, or None."""
+        row = self._connect().execute('SELECT finished FROM task_runs WHERE task = ?',
+                                      (taskname,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_last_run(self, taskname, finished):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO task_runs VALUES (?, ?)',
+                         (taskname, finished))
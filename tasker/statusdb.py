@@ -0,0 +1,236 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Central stores of worker status, for watching many directories at once.
+
+Workers report to a store as well as to the status file in their own
+directory (see the Tasker's 'status_store' option); Monitor(store=...) then
+reads the whole fleet's status in one query.
+
+SQLiteStatusStore is a database that all workers write to directly.
+SocketStatusStore sends reports to a StatusCollector process on the same
+machine, which keeps them in a SQLiteStatusStore of its own. Run one with
+
+    python -m tasker.statusdb collect SOCKET DATABASE
+"""
+import six
+import os, sys, time
+import json
+import socket
+import sqlite3
+import argparse
+import threading
+import pandas
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS latest (
+        absdir TEXT PRIMARY KEY, task TEXT, updated REAL, info TEXT)""",
+    """CREATE TABLE IF NOT EXISTS history (
+        absdir TEXT, task TEXT, updated REAL, info TEXT)""",
+    """CREATE INDEX IF NOT EXISTS history_key ON history (absdir, task, updated)""",
+    ]
+
+
+class SQLiteStatusStore(object):
+    """Status reports from many directories, in a SQLite database.
+
+    Keeps the latest report from each directory, and the last 'history'
+    reports for each (directory, task).
+
+    'wal' : use write-ahead logging, so that readers and writers do not block
+        each other. This requires all processes to be on the same machine;
+        for a database on a network filesystem shared between machines,
+        use wal=False.
+    """
+    def __init__(self, filename, history=100, wal=True):
+        self.filename = os.path.abspath(filename)
+        self.history = history
+        self.wal = wal
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=60)
+            if self.wal:
+                conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                for stmt in _SCHEMA:
+                    conn.execute(stmt)
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def put(self, absdir, info, updated=None):
+        """Record status 'info' (a dict) for directory 'absdir'."""
+        if updated is None:
+            updated = time.time()
+        task, infojson = info.get('task'), json.dumps(info)
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?)',
+                         (absdir, task, updated, infojson))
+            conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)',
+                         (absdir, task, updated, infojson))
+            conn.execute('DELETE FROM history WHERE absdir = ? AND task IS ? AND '
+                         'updated < (SELECT updated FROM history WHERE absdir = ? '
+                         'AND task IS ? ORDER BY updated DESC LIMIT 1 OFFSET ?)',
+                         (absdir, task, absdir, task, self.history - 1))
+
+    def latest(self, absdirs=None):
+        """Latest report from each directory, as {absdir: (updated, info)}.
+
+        'absdirs' limits the result to those directories (optional).
+        """
+        rows = self._connect().execute(
+            'SELECT absdir, updated, info FROM latest').fetchall()
+        if absdirs is not None:
+            absdirs = set(absdirs)
+            rows = [r for r in rows if r[0] in absdirs]
+        return dict((r[0], (r[1], json.loads(r[2]))) for r in rows)
+
+    def get_history(self, absdir, task=None):
+        """Recent reports from 'absdir' (and 'task', if given), oldest first.
+
+        Returns a DataFrame with 'updated' (time.time()) and the reported
+        information.
+        """
+        query = 'SELECT updated, info FROM history WHERE absdir = ?'
+        args = (absdir,)
+        if task is not None:
+            query += ' AND task = ?'
+            args += (task,)
+        rows = self._connect().execute(query + ' ORDER BY updated', args).fetchall()
+        return pandas.DataFrame([dict(json.loads(info), updated=updated)
+                                 for updated, info in rows])
+
+    def close(self):
+        """Close this thread's connection to the database."""
+        local = self._local
+        if getattr(local, 'conn', None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
+
+
+class SocketStatusStore(object):
+    """Sends status reports to a StatusCollector listening at 'path'.
+
+    Reports are sent without waiting for a reply. If no collector is
+    listening, they are dropped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def put(self, absdir, info, updated=None):
+        if updated is None:
+            updated = time.time()
+        local = self._local
+        if getattr(local, 'sock', None) is None or local.pid != os.getpid():
+            local.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            local.pid = os.getpid()
+        msg = json.dumps({'absdir': absdir, 'updated': updated, 'info': info})
+        try:
+            local.sock.sendto(msg.encode('utf-8'), self.path)
+        except (OSError, socket.error):
+            pass  # No collector
+
+
+class StatusCollector(object):
+    """Receives reports from SocketStatusStore instances, and puts them in 'store'.
+
+    'path' is the Unix socket to listen on; 'store' is a SQLiteStatusStore.
+    """
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self._sock = None
+
+    def bind(self):
+        """Start listening. (Done by serve_forever(), if need be.)"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left by a previous collector
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+
+    def handle(self, timeout=None):
+        """Receive and store one report. Returns False on timeout."""
+        if self._sock is None:
+            self.bind()
+        self._sock.settimeout(timeout)
+        try:
+            data = self._sock.recv(1 << 20)
+        except socket.timeout:
+            return False
+        try:
+            msg = json.loads(data.decode('utf-8'))
+            self.store.put(msg['absdir'], msg['info'], msg['updated'])
+        except (ValueError, KeyError, TypeError):
+            pass  # Not one of ours
+        return True
+
+    def serve_forever(self):
+        if self._sock is None:
+            self.bind()
+        try:
+            while True:
+                self.handle()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def open_status_store(spec):
+    """Make a status store from a description like "sqlite:PATH" or "unix:PATH".
+
+    Anything else (e.g. an existing store) is returned unchanged.
+    """
+    if isinstance(spec, six.string_types):
+        kind, _, path = spec.partition(':')
+        if kind == 'sqlite':
+            return SQLiteStatusStore(path)
+        elif kind == 'unix':
+            return SocketStatusStore(path)
+        raise ValueError('Unknown status store "%s"' % spec)
+    return spec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tasker.statusdb')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('collect', help='receive status reports on a Unix socket')
+    p.add_argument('socket')
+    p.add_argument('database')
+    p.add_argument('--history', type=int, default=100,
+                   help='reports to keep for each directory and task')
+    args = parser.parse_args(argv)
+    if args.command != 'collect':
+        parser.print_help()
+        return 2
+    collector = StatusCollector(args.socket,
+                                SQLiteStatusStore(args.database, args.history))
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,14 +13,28 @@
 #   limitations under the License.
 import six
 import os
+import copy
 import json
+import threading
+import contextlib
+import weakref
+from collections import OrderedDict
+try:
+    from collections.abc import Iterator
+except ImportError:  # Python 2
+    from collections import Iterator
 from path import Path
 
 if six.PY2:
     import cPickle
 else:
     import _pickle as cPickle
-__all__ = ['Pandas', 'JSON', 'Pickle']
+import pickle
+__all__ = ['Pandas', 'JSON', 'JSONLines', 'Pickle', 'NumPy', 'Parquet']
+
+def is_stream(data):
+    """True if 'data' is an iterator, to be saved (or read) piece by piece."""
+    return isinstance(data, Iterator)
 
 class FileBase(object):
     def __init__(self, filename, parentdir='.'):
@@ -35,6 +49,26 @@ class FileBase(object):
             self.filepath = (self.parentdir / self.filename).normpath().abspath()
     def read(self): pass # Uses self.filepath
     def save(self, data): pass # Uses self.filepath
+    @classmethod
+    def save_together(cls, items):
+        """Save several (instance, data) pairs that refer to the same file."""
+        for fileobj, data in items:
+            fileobj.save(data)
+    def _identity(self):
+        """Tuple that identifies the data this instance refers to."""
+        return (type(self).__name__, str(self.filepath))
+    def _renamed(self, filename):
+        """Copy of this instance that refers to 'filename' instead."""
+        other = copy.copy(self)
+        other.filename = Path(filename).normpath()
+        other.set_parentdir(self.parentdir)
+        return other
+    def _tmpname(self):
+        """Name of a temporary file, next to self.filepath, that is unique to
+        this process and thread.
+        """
+        return self.filepath + '.%i-%i._tmp' % (os.getpid(),
+                                                threading.current_thread().ident)
     def _mkdir(self):
         """Makes directory that self.filepath goes in, if it does
         not exist.
@@ -44,24 +78,150 @@ class FileBase(object):
         return self.read()
     # TODO: Useful __repr__()
 
+class HDFPool(object):
+    """Open pandas.HDFStore handles for reading, kept for reuse.
+
+    While a pool is active in a thread (see hdf_pool()), Pandas instances
+    read through it, so that a file is opened (and its metadata parsed)
+    once, however many objects are read from it. A handle is reopened if the
+    file has since changed on disk. Before a Pandas instance writes to a
+    file, handles to it in all pools are closed.
+
+    At most 'max_open' handles are kept; beyond that, the least recently
+    used is closed.
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._stores = OrderedDict()  # filepath -> (signature, HDFStore)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        with _pools_lock:
+            _pools.add(self)
+
+    @contextlib.contextmanager
+    def opened(self, filepath):
+        """Context manager that yields a read-only HDFStore for 'filepath'.
+
+        The handle is not closed (e.g. by release()) until the block exits.
+        """
+        import pandas
+        filepath = str(filepath)
+        st = os.stat(filepath)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if self._pid != os.getpid():  # Handles belong to parent process
+                self._stores, self._pid = OrderedDict(), os.getpid()
+            entry = self._stores.pop(filepath, None)
+            if entry is not None and entry[0] != signature:
+                entry[1].close()
+                entry = None
+            if entry is None:
+                entry = (signature, pandas.HDFStore(filepath, 'r'))
+            self._stores[filepath] = entry  # Now the most recently used
+            while len(self._stores) > self.max_open:
+                self._stores.popitem(last=False)[1][1].close()
+            yield entry[1]
+
+    def release(self, filepath):
+        """Close any handle to 'filepath', once it is no longer in use."""
+        with self._lock:
+            entry = self._stores.pop(str(filepath), None)
+            if entry is not None and self._pid == os.getpid():
+                entry[1].close()
+
+    def close(self):
+        """Close all handles."""
+        with self._lock:
+            stores, self._stores = self._stores, OrderedDict()
+            if self._pid == os.getpid():
+                for signature, hdf in stores.values():
+                    hdf.close()
+
+    def __len__(self):
+        return len(self._stores)
+
+_pools = weakref.WeakSet()  # All HDFPool instances in this process
+_pools_lock = threading.Lock()
+_hdf_local = threading.local()
+
+def active_hdf_pool():
+    """The HDFPool in use by this thread, or None."""
+    return getattr(_hdf_local, 'pool', None)
+
+@contextlib.contextmanager
+def hdf_pool():
+    """Context manager in which this thread reuses HDFStore handles.
+
+    Yields the HDFPool, which is closed on exit. If one is already active,
+    it is used instead, and left open.
+    """
+    pool = active_hdf_pool()
+    if pool is not None:
+        yield pool
+        return
+    pool = _hdf_local.pool = HDFPool()
+    try:
+        yield pool
+    finally:
+        _hdf_local.pool = None
+        pool.close()
+
+def _release_hdf(filepath):
+    """Close pooled handles to 'filepath', in every thread, before it is written."""
+    with _pools_lock:
+        pools = list(_pools)
+    for pool in pools:
+        pool.release(filepath)
+
 class Pandas(FileBase):
-    """Store a Pandas data object."""
-    def __init__(self, filename, parentdir='.', key=None):
+    """Store a Pandas data object.
+
+    The data to save may also be an iterator (e.g. the generator returned by a
+    task function that yields its results piece by piece) of DataFrames or
+    Series. Each chunk is appended to a table-format store as it arrives,
+    so that the whole result never has to be in memory. Such a store can be
+    read back in pieces (see iter_chunks()). At least one chunk must have
+    rows, since HDF5 cannot store an empty table.
+    """
+    def __init__(self, filename, parentdir='.', key=None, chunksize=None):
         """Specify location of file. 
         
         If 'filename' is absolute, 'parentdir' is ignored.
 
         'key' gives the name of the Pandas object within the file.
             Defaults to the filename (minus extension).
+        'chunksize' : if given, read() returns an iterator over pieces of
+            (at most) this many rows, instead of the whole object. The object
+            must have been stored in table format (e.g. in chunks).
         """
         super(Pandas, self).__init__(filename, parentdir=parentdir)
+        self._default_key = key is None
         if key is None:
             self.key = os.path.splitext(os.path.basename(self.filepath))[0]
         else:
             self.key = key
+        self.chunksize = chunksize
 
-    def read(self):
+    def _identity(self):
+        return super(Pandas, self)._identity() + (self.key,)
+
+    def _renamed(self, filename):
+        other = super(Pandas, self)._renamed(filename)
+        if self._default_key:
+            other.key = os.path.splitext(os.path.basename(other.filepath))[0]
+        return other
+
+    def read(self, chunksize=None):
+        """Read the object. 'chunksize' overrides the one given to the constructor."""
         import pandas
+        if chunksize is None:
+            chunksize = self.chunksize
+        if chunksize is not None:
+            return self.iter_chunks(chunksize)
+        pool = active_hdf_pool()
+        if pool is not None:
+            with pool.opened(self.filepath) as hdf:
+                return hdf[self.key]
         hdf = pandas.HDFStore(self.filepath, 'r')
         try:
             r = hdf[self.key]
@@ -69,19 +229,76 @@ class Pandas(FileBase):
             hdf.close()
         return r
 
+    def iter_chunks(self, chunksize=100000):
+        """Iterate over a table-format object in pieces of 'chunksize' rows."""
+        import pandas
+        hdf = pandas.HDFStore(self.filepath, 'r')
+        try:
+            for chunk in hdf.select(self.key, chunksize=chunksize):
+                yield chunk
+        finally:
+            hdf.close()
+
     def save(self, data):
+        self.save_together([(self, data)])
+
+    @classmethod
+    def save_together(cls, items):
+        """Save several (instance, data) pairs to the same file, in a single open.
+
+        The file is replaced, so it then holds just these objects.
+        """
         import pandas
-        self._mkdir()
-        hdf = pandas.HDFStore(self.filepath, 'w')
+        fileobj = items[0][0]
+        fileobj._mkdir()
+        if len(items) == 1 and is_stream(items[0][1]):
+            fileobj._save_chunks(items[0][1])
+            return
+        _release_hdf(fileobj.filepath)
+        hdf = pandas.HDFStore(fileobj.filepath, 'w')
         try:
-            hdf[self.key] = data
+            for fo, data in items:
+                hdf[fo.key] = data
         finally:
             hdf.close()
 
+    def _save_chunks(self, chunks):
+        import pandas
+        # Work on a temporary file, so that if the chunks stop coming because
+        # of an error, there is no incomplete output to be mistaken for current.
+        tmpname = self._tmpname()
+        try:
+            hdf = pandas.HDFStore(tmpname, 'w')
+            try:
+                for chunk in chunks:
+                    hdf.append(self.key, chunk)
+                empty = self.key not in hdf
+            finally:
+                hdf.close()
+            if empty:  # Nothing would be there to read
+                raise ValueError('No chunks with rows were given to save as "%s" in %s'
+                                 % (self.key, self.filepath))
+            _release_hdf(self.filepath)
+            os.replace(tmpname, self.filepath)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
 class JSON(FileBase):
     """Store basic Python types (dicts, lists, floats, ints, etc.)
     in a human-readable text format.
     """
+    def __init__(self, filename, parentdir='.', compact=False):
+        """Specify location of file.
+
+        If 'filename' is absolute, 'parentdir' is ignored.
+
+        'compact' : if true, write without indentation or spaces, which is
+            smaller and faster for large data.
+        """
+        super(JSON, self).__init__(filename, parentdir=parentdir)
+        self.compact = compact
+
     def read(self):
         with open(self.filepath, 'r') as f:
             return json.load(f)
@@ -89,16 +306,267 @@ class JSON(FileBase):
     def save(self, data):
         self._mkdir()
         with open(self.filepath, 'w') as f:
-            json.dump(data, f, indent=4, separators=(',', ': '))
+            if self.compact:
+                json.dump(data, f, separators=(',', ':'))
+            else:
+                json.dump(data, f, indent=4, separators=(',', ': '))
+
+class JSONLines(FileBase):
+    """Store a sequence of records (basic Python types), one JSON document per line.
+
+    Records can be added to an existing file with append(), and read back
+    one at a time with iter_records(), so a long list never has to be in
+    memory. The data to save may also be an iterator (e.g. the generator
+    returned by a task function that yields records), which is written as
+    it comes.
+    """
+    def __init__(self, filename, parentdir='.', stream=False):
+        """Specify location of file.
+
+        If 'filename' is absolute, 'parentdir' is ignored.
+
+        'stream' : if true, read() returns an iterator over the records,
+            instead of a list.
+        """
+        super(JSONLines, self).__init__(filename, parentdir=parentdir)
+        self.stream = stream
+
+    def read(self, stream=None):
+        """Read the records. 'stream' overrides the one given to the constructor."""
+        if stream is None:
+            stream = self.stream
+        if stream:
+            return self.iter_records()
+        return list(self.iter_records())
+
+    def iter_records(self):
+        """Iterate over the records in the file."""
+        with open(self.filepath, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _write_records(self, f, records):
+        for rec in records:
+            f.write(json.dumps(rec, separators=(',', ':')))
+            f.write('\n')
+
+    def save(self, data):
+        self._mkdir()
+        # Work on a temporary file, so that if the records stop coming because
+        # of an error, there is no incomplete output to be mistaken for current.
+        tmpname = self._tmpname()
+        try:
+            with open(tmpname, 'w') as f:
+                self._write_records(f, data)
+            os.replace(tmpname, self.filepath)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    def append(self, records):
+        """Add 'records' (any iterable) to the end of the file, creating it if necessary."""
+        self._mkdir()
+        with open(self.filepath, 'a') as f:
+            self._write_records(f, records)
+
+_PICKLE_MAGIC = b'TASKER-PICKLE\n'
+_PICKLE_CODECS = (None, 'gzip', 'bz2', 'lzma')
+
+def _codec_file(codec, fileobj, mode):
+    """Wrap 'fileobj' to compress or decompress with 'codec'."""
+    if codec is None:
+        return fileobj
+    elif codec == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=fileobj, mode=mode)
+    elif codec == 'bz2':
+        import bz2
+        return bz2.BZ2File(fileobj, mode)
+    elif codec == 'lzma':
+        import lzma
+        return lzma.LZMAFile(fileobj, mode)
+    else:
+        raise ValueError('Unknown compression "%s"' % codec)
+
+def _readinto_all(f, buf):
+    """Fill 'buf' from file 'f', which may return fewer bytes at a time."""
+    view = memoryview(buf)
+    while len(view):
+        n = f.readinto(view)
+        if not n:
+            raise IOError('Unexpected end of file')
+        view = view[n:]
 
 class Pickle(FileBase):
     """Store most any Python object in a Python-only binary format.
     """
+    def __init__(self, filename, parentdir='.', compression=None,
+                 out_of_band=False):
+        """Specify location of file.
+
+        If 'filename' is absolute, 'parentdir' is ignored.
+
+        Giving either of these options selects a newer file format, with
+        pickle protocol 5 and a header that records how the file was written:
+        'compression' : "gzip", "bz2", or "lzma" (default: none).
+        'out_of_band' : if true, large binary data such as NumPy arrays and
+            pandas objects are written straight from memory, after the rest of
+            the pickle, and read straight into the memory they will occupy.
+
+        Files in either format can always be read.
+        """
+        super(Pickle, self).__init__(filename, parentdir=parentdir)
+        if compression not in _PICKLE_CODECS:
+            raise ValueError('Unknown compression "%s"' % compression)
+        self.compression = compression
+        self.out_of_band = out_of_band
+
     def read(self):
         with open(self.filepath, 'rb') as f:
-            return cPickle.load(f)
+            if f.read(len(_PICKLE_MAGIC)) != _PICKLE_MAGIC:
+                f.seek(0)
+                return cPickle.load(f)
+            header = json.loads(f.readline().decode('ascii'))
+            cf = _codec_file(header['codec'], f, 'rb')
+            try:
+                pickled = bytearray(header['pickle'])
+                _readinto_all(cf, pickled)
+                buffers = []
+                for size in header['buffers']:
+                    buf = bytearray(size)
+                    _readinto_all(cf, buf)
+                    buffers.append(buf)
+            finally:
+                if cf is not f:
+                    cf.close()
+            return pickle.loads(pickled, buffers=buffers)
 
     def save(self, data):
         self._mkdir()
+        if self.compression is None and not self.out_of_band:
+            with open(self.filepath, 'wb') as f:
+                cPickle.dump(data, f)
+            return
+        buffers = []
+        def buffer_callback(pb):
+            if not self.out_of_band:
+                return True  # Keep in pickle
+            try:
+                buffers.append(pb.raw())
+            except BufferError:  # Not contiguous
+                return True
+            return False
+        pickled = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+        header = {'codec': self.compression, 'pickle': len(pickled),
+                  'buffers': [b.nbytes for b in buffers]}
         with open(self.filepath, 'wb') as f:
-            cPickle.dump(data, f)
+            f.write(_PICKLE_MAGIC)
+            f.write(json.dumps(header).encode('ascii') + b'\n')
+            cf = _codec_file(self.compression, f, 'wb')
+            try:
+                cf.write(pickled)
+                for buf in buffers:
+                    cf.write(buf)
+            finally:
+                if cf is not f:
+                    cf.close()
+
+class NumPy(FileBase):
+    """Store NumPy arrays in NumPy's own binary format.
+
+    If the filename ends in ".npz", the data must be a dict of arrays, which
+    are stored together in one archive; otherwise a single array is stored
+    in ".npy" format.
+    """
+    def __init__(self, filename, parentdir='.', mmap_mode='r', compress=False):
+        """Specify location of file.
+
+        If 'filename' is absolute, 'parentdir' is ignored.
+
+        'mmap_mode' is passed to numpy.load() when reading a single array.
+            The default, 'r', maps the file into memory read-only, so only
+            the parts that are actually used get read from disk, and several
+            processes can share them. Use None to read the whole array.
+            (Arrays in .npz archives are always read in full.)
+        'compress' : whether to compress .npz archives.
+        """
+        super(NumPy, self).__init__(filename, parentdir=parentdir)
+        self.mmap_mode = mmap_mode
+        self.compress = compress
+
+    def _is_archive(self):
+        return self.filepath.ext.lower() == '.npz'
+
+    def read(self):
+        import numpy
+        if self._is_archive():
+            with numpy.load(str(self.filepath), allow_pickle=False) as npz:
+                return dict(npz)
+        return numpy.load(str(self.filepath), mmap_mode=self.mmap_mode,
+                          allow_pickle=False)
+
+    def save(self, data):
+        import numpy
+        self._mkdir()
+        # Write a new file, rather than overwriting one that may be mapped
+        # into memory by a reader.
+        tmpname = self._tmpname()
+        try:
+            with open(tmpname, 'wb') as f:
+                if self._is_archive():
+                    if self.compress:
+                        numpy.savez_compressed(f, **data)
+                    else:
+                        numpy.savez(f, **data)
+                else:
+                    numpy.save(f, numpy.asanyarray(data), allow_pickle=False)
+            os.replace(tmpname, self.filepath)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+class Parquet(FileBase):
+    """Store a Pandas DataFrame in the columnar Parquet format (requires pyarrow).
+
+    Readers can ask for just some of the columns, and for just the rows that
+    pass simple filters, so that only part of the file is read. These can be
+    set when specifying a task's inputs, either here or with
+    TaskUnit.select().
+    """
+    def __init__(self, filename, parentdir='.', columns=None, filters=None):
+        """Specify location of file.
+
+        If 'filename' is absolute, 'parentdir' is ignored.
+
+        'columns' : names of the columns to read (default: all).
+        'filters' : rows to read, as for pyarrow.parquet.read_table(): a list of
+            (column, op, value) tuples that must all be true, e.g.
+            [('frame', '>=', 100), ('particle', 'in', [1, 2])].
+        """
+        super(Parquet, self).__init__(filename, parentdir=parentdir)
+        self.columns = columns
+        self.filters = filters
+
+    def _identity(self):
+        return super(Parquet, self)._identity() + \
+            (repr(self.columns), repr(self.filters))
+
+    def read(self, columns=None, filters=None):
+        """Read the file. 'columns' and 'filters' override those given
+        to the constructor."""
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(
+            str(self.filepath),
+            columns=self.columns if columns is None else columns,
+            filters=self.filters if filters is None else filters)
+        return table.to_pandas()
+
+    def save(self, data):
+        """Save a DataFrame (or a Series, which is read back as a DataFrame)."""
+        import pandas, pyarrow, pyarrow.parquet
+        self._mkdir()
+        if isinstance(data, pandas.Series):
+            data = data.to_frame()
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(data),
+                                    str(self.filepath))
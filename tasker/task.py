@@ -13,19 +13,32 @@
 #   limitations under the License.
 import six
 from functools import reduce
-import os, sys
+import os, sys, time
+import hashlib, sqlite3
 import inspect, contextlib, functools
+import multiprocessing, multiprocessing.connection
+import threading
+from concurrent import futures
 from collections import OrderedDict
 from warnings import warn
 import json
 
 from path import Path
 
-from .base import DirBase, AttrDict
-from .storage import FileBase
+from .base import DirBase, AttrDict, cachedprop
+from .storage import FileBase, is_stream, hdf_pool
+from .cache import read_cache
 from .progress import Progress, DEFAULT_STATUS_FILE, DEFAULT_STATUS_DIR
+from .state import BuildState, DEFAULT_STATE_FILE, stat_signature
+from .metadata import StatCache
+from .statusdb import open_status_store
+from .accounting import ResourceMeter, record_run, read_runs, summarize, total_size
 from . import debug
 from .debug import tasker_traceback
+if six.PY2:
+    _async = None
+else:
+    from . import _async
 
 if six.PY2:
     from exceptions import IOError
@@ -78,6 +91,169 @@ def _nestmap(fcn, data_part):
             else:
                 raise
 
+def _group_outputs(pairs):
+    """Collect (output spec, data) pairs into lists that are saved together.
+
+    Only FileBase instances are kept. Those of the same type that refer to
+    the same file (e.g. several Pandas objects with different keys) are
+    grouped, in order of first appearance.
+    """
+    groups = OrderedDict()
+    for of, od in pairs:
+        if isinstance(of, FileBase):
+            groups.setdefault((type(of), str(of.filepath)), []).append((of, od))
+    return list(groups.values())
+
+class _Writer(object):
+    """Performs save operations in order, on a background thread."""
+    def __init__(self):
+        self._pool = None
+        self._pending = []
+
+    def submit(self, fcn, *args):
+        """Queue fcn(*args). Returns a Future."""
+        if self._pool is None:
+            self._pool = futures.ThreadPoolExecutor(1)
+        future = self._pool.submit(fcn, *args)
+        self._pending.append(future)
+        return future
+
+    def submit_after(self, future, fcn, *args):
+        """Queue fcn(*args), to be skipped if 'future' (from submit()) failed."""
+        def call():
+            if future.exception() is None:
+                return fcn(*args)
+        return self.submit(call)
+
+    def flush(self):
+        """Wait for everything submitted so far. Raises the first error, if any."""
+        pending, self._pending = self._pending, []
+        errors = [f.exception() for f in pending]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+class _WalkPass(object):
+    """State shared by all tasks visited during one call to TaskUnit._walk_up().
+
+    'results' maps each TaskUnit to its result dict, or to None while
+    that task's dependencies are still being examined (which is how
+    cycles are detected).
+
+    'stats' is a StatCache through which all file information is obtained.
+
+    During a sync, 'handoff' maps tasks that have just run to their outputs
+    (in the form returned by load()), and 'writer' holds their deferred
+    saves, if any. The files being written are listed in 'pending_files'.
+
+    A pass made while 'outer' is active (e.g. by a task function that calls
+    sync()) shares all of these with it, except the results.
+    """
+    def __init__(self, stats=None, outer=None):
+        self.results = {}
+        self.needed_tasks = []
+        self.visited_tasks = []
+        if outer is None:
+            self.stats = StatCache() if stats is None else stats
+            self.handoff = {}
+            self.writer = _Writer()
+            self.pending_files = set()
+        else:
+            self.stats = outer.stats
+            self.handoff = outer.handoff
+            self.writer = outer.writer
+            self.pending_files = outer.pending_files
+
+    def flush(self):
+        """Wait for deferred saves, so that files on disk are up to date."""
+        self.writer.flush()
+        self.stats.forget(self.pending_files)
+        self.pending_files.clear()
+
+
+_active = threading.local()  # 'walk' is the sync pass in progress in this thread
+
+
+def _read_file(fileobj, read_kw=None):
+    """Read a FileBase instance, after any deferred saves in this thread."""
+    walk = getattr(_active, 'walk', None)
+    if walk is not None:
+        walk.flush()
+    if read_kw:
+        return fileobj.read(**read_kw)
+    return read_cache.read(fileobj)
+
+
+class LazyOutput(object):
+    """Stand-in for the contents of a task's output file, read when first needed.
+
+    Call it (or use its 'value') to get the data, which is then kept.
+    As a convenience, attribute access, indexing, len() and iteration are
+    passed through to the data.
+    """
+    def __init__(self, fileobj, read_kw=None):
+        self.fileobj = fileobj
+        self.read_kw = read_kw
+
+    @cachedprop
+    def value(self):
+        return _read_file(self.fileobj, self.read_kw)
+
+    def __call__(self):
+        return self.value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __repr__(self):
+        return 'LazyOutput: %s' % self.fileobj.filepath
+
+
+class _Selection(object):
+    """The outputs of a task, to be read with extra arguments, or lazily.
+
+    Created by TaskUnit.select().
+    """
+    def __init__(self, task, read_kw, lazy=False):
+        self.task = task
+        self.read_kw = read_kw
+        self.lazy = lazy
+
+    def read(self):
+        tsk = self.task
+        def prepare(part):
+            if not isinstance(part, FileBase):
+                return tsk._get_filename(part)
+            elif self.lazy:
+                return LazyOutput(part, self.read_kw)
+            else:
+                return _read_file(part, self.read_kw)
+        return _nestmap(prepare, tsk._outs_as_given)
+
+    def __repr__(self):
+        return 'Selection from %r: %r' % (self.task, self.read_kw)
+
+
 class TaskUnit(object):
     """Represents a single task within a Tasker instance.
     Ordinarily one uses the computes() and stores() methods of
@@ -89,7 +265,8 @@ class TaskUnit(object):
     Parameters:
     'func' is a function which turns 'ins' into 'outs'.
     'ins' is some data structure (preferably list or dict) populated
-        with filenames, FileBase instances, or other TaskUnit instances.
+        with filenames, FileBase instances, or other TaskUnit instances
+        (or parts of their output; see select()).
     'outs' is a filename or FileBase instance, or a list thereof.
     'tasker' is a parent Tasker instance, which presently serves to
         set the working directory for this task.
@@ -104,10 +281,14 @@ class TaskUnit(object):
     'func' returns a list (or single value) which corresponds to the elements of
     'outs'. Elements not corresponding to a FileBase instance are ignored; the
     contents of those files must be writen with code inside 'func',
-    and read by a separate function.
+    and read by a separate function. If the only output is a Pandas or
+    JSONLines file, 'func' may instead be a generator that yields its result
+    in chunks (or records), which are written as they come.
 
     In general, any filename can be either relative to the task's working directory.
-    or absolute. 'func' will always be executed in the task's working directory.
+    or absolute. 'func' will be executed in the task's working directory, unless
+    the tasker was created with chdir=False. In that case 'func' must not rely
+    on the process's working directory; it can find its directory as 'tsk.p'.
 
     When a user asks for the outputs of 'func', they are loaded from disk and
     returned as a dict, which is indexed just like in the argument to 'func'.
@@ -131,7 +312,10 @@ class TaskUnit(object):
         self.input_files, self.input_tasks = self._flatten_dependencies()
 
         self._running = False # Prevent recursion
-        self._syncing = False # Prevent recursion
+        self._deferred_saves = None  # Set by _run_func()
+        self._saving = None  # Future of the deferred saves, set by __exit__()
+        self._run_lock = threading.RLock()  # Held while deciding to run, and running
+        self._last_saving = None  # Future of the latest run's deferred saves
 
     # Deal with arbitrary user specification of task inputs/outputs
     def _get_filename(self, fileobj):
@@ -157,8 +341,13 @@ class TaskUnit(object):
         if isinstance(data_part, (str, unicode_var, Path)): # Literal filename
             return self._get_filename(data_part)
         elif isinstance(data_part, FileBase): # Formatted file
+            return _read_file(data_part)
+        elif isinstance(data_part, _Selection): # Part of another task's output
             return data_part.read()
         elif isinstance(data_part, TaskUnit): # Another task
+            walk = getattr(_active, 'walk', None)
+            if walk is not None and data_part in walk.handoff:
+                return walk.handoff[data_part]  # Just computed
             # Continued by that task, so that its working dir, etc. are used
             try:
                 return data_part.load()
@@ -191,6 +380,8 @@ class TaskUnit(object):
             return [in_part,]
         elif isinstance(in_part, TaskUnit):
             return [in_part,] + list(in_part.output_files)
+        elif isinstance(in_part, _Selection):
+            return [in_part.task,] + list(in_part.task.output_files)
         elif isinstance(in_part, dict):
             return flatten([self._flatten_dependencies_recurse(v) \
                     for v in in_part.values()])
@@ -212,17 +403,24 @@ class TaskUnit(object):
         if self.tasker.is_working(task=self.__name__):  # Suspenders and a belt
             raise LockException('%s says task "%s" is already running there.' % \
                                 (self._lockfile, self.__name__))
-        self._old_dir = os.getcwd()
+        self._old_dir = os.getcwd() if self.tasker.chdir else None
         try:
             self._running = True
-            os.chdir(self.p)
+            if self.tasker.chdir:
+                os.chdir(self.p)
             self.progress = Progress(persistent_info={
-                'task': self.__name__, 'pid': os.getpid(), })
-            self._lockfile.dirname().makedirs_p()
-            self._lockfile.touch() # Establish lock
+                'task': self.__name__, 'pid': os.getpid(), },
+                filename=self.p / DEFAULT_STATUS_FILE,
+                interval=self.tasker.status_interval,
+                background=self.tasker.status_background,
+                store=self.tasker.status_store)
+            with self._span('lock_wait'):
+                self._lockfile.dirname().makedirs_p()
+                self._lockfile.touch() # Establish lock
             self.progress.working()
             try:
-                ins = _nestmap(self._prepare_data, self._ins_as_given)
+                with self._span('load_inputs'):
+                    ins = _nestmap(self._prepare_data, self._ins_as_given)
             except:
                 # Remove ourselves from the call stack
                 if debug.EDIT_TRACEBACKS:
@@ -238,13 +436,54 @@ class TaskUnit(object):
 
     def __exit__(self, typ, val, tb):
         """Context manager counterpart to __enter__"""
-        if tb is not None:
-            self.progress.update({'status': 'ERROR'})
-        else:
-            self.progress._finish()  # Change status to "done"
-        self._running = False
-        if self._lockfile.exists(): self._lockfile.unlink()
-        os.chdir(self._old_dir)
+        deferred, self._deferred_saves = self._deferred_saves, None
+        try:
+            if tb is None and deferred:
+                # Keep the lock, and say "working", until the outputs are on disk
+                self._saving = _active.walk.writer.submit(
+                    self._save_deferred, deferred, self.progress, self._lockfile)
+            else:
+                self._release(self.progress, self._lockfile, tb is None)
+        finally:
+            self._running = False
+            if self._old_dir is not None:
+                os.chdir(self._old_dir)
+
+    @staticmethod
+    def _release(progress, lockfile, ok, superseded=False):
+        """Report the outcome of a run, and unlock.
+
+        If 'superseded', another task has reported since, and a success is
+        not reported over it. Failing to write the status only warns, since
+        the outcome of the run does not depend on it; the lock is always
+        released.
+        """
+        try:
+            if not ok:
+                progress.update({'status': 'ERROR'})
+            elif not superseded:
+                progress._finish()  # Change status to "done"
+            progress.close()
+        except Exception as e:
+            warn('Could not write the final status to %s: %r' %
+                 (progress.filename, e))
+        finally:
+            if lockfile.exists(): lockfile.unlink()
+
+    def _save_deferred(self, groups, progress, lockfile):
+        """Save groups of outputs on the background writer, then finish the run."""
+        ok = False
+        try:
+            for group in groups:
+                self._save_outputs(group)
+            ok = True
+        finally:
+            try:
+                with open(self.p / DEFAULT_STATUS_FILE) as f:
+                    superseded = json.load(f).get('task') != self.__name__
+            except (IOError, ValueError):
+                superseded = False
+            self._release(progress, lockfile, ok, superseded)
 
     def __repr__(self):
         return 'TaskUnit: ' + self.func.__name__
@@ -252,91 +491,296 @@ class TaskUnit(object):
     def __hash__(self):
         return id(self) # So we can put these in sets
 
-    def _output_mtime(self):
+    def _output_mtime(self, stats=None):
         """Newest modification time of output files.
 
         None if no outputs defined; -1 if any are missing.
+
+        stats : StatCache to consult (optional)
         """
         if not len(self.output_files):
             return None
         else:
+            if stats is None:
+                stats = StatCache()
             try:
-                return max([of.mtime for of in self.output_files])
+                return max([stats.mtime(of) for of in self.output_files])
             except OSError:
                 return -1  # Missing file
 
-    def _walk_up(self, run=False, force=False):
+    def _signature_files(self):
+        """Files whose contents determine this task's inputs.
+
+        Includes the inputs of upstream tasks that do not store their outputs,
+        since their values are computed afresh from those files.
+        """
+        files = list(self.input_files)
+        for it in self.input_tasks:
+            if not it.output_files:
+                files.extend(it._signature_files())
+        return files
+
+    def _input_digest(self, stats=None):
+        """Content signature of this task's inputs (for "hash" staleness)."""
+        return self.tasker.build_state.files_digest(self._signature_files(),
+                                                    stats=stats)
+
+    def _artifact_key(self):
+        """Key for this task's outputs in the tasker's artifact cache.
+
+        Depends on the task's name and source code, its output filenames,
+        and the contents of its input files, but not on its directory.
+        """
+        def portable(fn):
+            rel = os.path.relpath(fn, self.p)
+            return fn if rel.startswith(os.pardir) else rel
+        state = self.tasker.build_state
+        inputs = []
+        for fn in sorted(set(map(str, self._signature_files()))):
+            try:
+                digest = state.file_digest(fn)
+            except OSError:
+                digest = 'missing'
+            inputs.append([portable(fn), digest])
+        func = inspect.unwrap(self.func)
+        try:
+            code = inspect.getsource(func)
+        except (OSError, TypeError):  # Source not available
+            code = repr(func.__code__.co_code) if hasattr(func, '__code__') \
+                    else func.__name__
+        desc = [self.__name__, code, [portable(str(f)) for f in self.output_files],
+                inputs]
+        return hashlib.sha1(json.dumps(desc).encode('utf-8')).hexdigest()
+
+    def _hash_current(self, up_current, run, stats=None):
+        """Decide staleness of a task with stored outputs from input contents.
+
+        Returns True or False, or None if there is no recorded signature to
+        compare with (in which case modification times decide).
+        """
+        if not (run or up_current):
+            # Upstream tasks will be re-run first, so inputs will presumably change
+            return None
+        recorded = self.tasker.build_state.task_digest(self.__name__)
+        if recorded is None:
+            return None
+        return recorded == self._input_digest(stats)
+
+    def _walk_up(self, run=False, force=False, walk=None):
         """Go up the dependency tree, looking for out-of-date tasks,
         including this one.
 
         run : if true, run() tasks that are out of date.
         force : if true, run *this* task whether it is out of date or not.
+        walk : _WalkPass instance shared by all tasks visited in this
+            traversal (created if not given).
+
+        Each task is evaluated at most once per pass; tasks that are reached
+        again by another path (e.g. a diamond-shaped pipeline) reuse
+        their earlier result.
+
+        A pass with run=True becomes the active one for this thread until it
+        finishes; syncs started in the meantime (e.g. by tasks that do not
+        store their outputs) share its handoff of freshly computed outputs,
+        and its background writer. Deferred saves are finished before any
+        new pass looks at the disk, and before the active pass returns.
 
         Notes on returned dictionary keys:
             all_current : not (Does/will this task need to be run()?)
             done : Can the output be produced trivially?
                 (For tasks that don't store their output, are all deps up to date?)
+            needed_tasks, visited_tasks : Accumulated over the whole pass.
         """
-        if self._syncing:
-            raise RuntimeError('Cyclic dependency: "%s" somehow depends on '
-                'itself.' % self.__name__)
+        outer = getattr(_active, 'walk', None)
+        if outer is not None:
+            outer.flush()
+        if walk is None:
+            walk = _WalkPass(outer=outer)
+        walk.stats.prefetch(f for t in self._closure()
+                            for f in t.input_files + t.output_files)
+        if not run or outer is not None:
+            return self._visit(walk, run, force)
+        _active.walk = walk
         try:
-            self._syncing = True
-            up_results = [it._walk_up(run=run) for it in self.input_tasks]
-        finally:
-            self._syncing = False
+            with hdf_pool():  # Reuse file handles for the rest of the pass
+                result = self._visit(walk, run, force)
+        except:
+            _active.walk = None
+            try:
+                walk.writer.close()
+            except Exception as e:
+                warn('Error while saving task outputs: %r' % e)
+            raise
+        _active.walk = None
+        walk.writer.close()
+        return result
+
+    def _visit(self, walk, run=False, force=False):
+        """Examine this task for _walk_up(), after its upstream tasks."""
+        if self in walk.results:
+            if walk.results[self] is None:
+                raise RuntimeError('Cyclic dependency: "%s" somehow depends on '
+                    'itself.' % self.__name__)
+            return walk.results[self]
+        walk.results[self] = None  # In progress
+        walk.visited_tasks.append(self)
+        up_results = [it._visit(walk, run) for it in self.input_tasks]
 
         result = dict(
             all_current=all(ur['all_current'] for ur in up_results),
                 # Note that all([]) == True
-            needed_tasks=reduce(lambda a,b: a+b,
-                                [ur['needed_tasks'] for ur in up_results], []),
-            visited_tasks=reduce(lambda a,b: a+b,
-                                [ur['visited_tasks'] for ur in up_results], [self,]),
+            needed_tasks=walk.needed_tasks,
+            visited_tasks=walk.visited_tasks,
             )
 
-        input_mtimes = [-1] + [ur['mtime'] for ur in up_results]
-        missing_files = []
-        for inf in self.input_files:
-            try:
-                input_mtimes.append(inf.mtime)
-            except OSError:
-                missing_files.append(inf)
-        output_mtime = self._output_mtime()
-
-        # Run task if missing outputs, stale outputs, or an upstream task has been re-run.
-        # Note that missing *inputs* do not trigger a run, which would presumably fail.
-        # This is to prevent a scenario in which the user deletes an obscure input file,
-        # asks for a downstream value, thus inadvertently wipes the entire chain of stored values,
-        # and has no way to recompute anything.
-        if force or output_mtime == -1 or \
-                    (output_mtime is not None and output_mtime < max(input_mtimes)) or \
-                    not result['all_current']:
-            result['all_current'] = False
-            result['needed_tasks'].append(self)
-            result['done'] = False
-            if run:
-                for missing_file in missing_files:
-                    warn('Attempting to run task "%s", but required file "%s" is '
-                         'missing. Failure is likely.' % (self.__name__, missing_file))
-                self.run()
-                output_mtime = self._output_mtime()
-                if output_mtime is not None and output_mtime < max(input_mtimes):
-                    raise RuntimeError('Task "%s" failed to update its output files.'
-                                       % self.__name__)
-        elif output_mtime is None and (  # This task does not store its outputs, and
-            missing_files  # It reads files that are missing, or
-            or not all(ur['done'] for ur in up_results)):  # It depends on tasks that are not computed
+        with self._exclusive(walk, run):
+            with self._span('stale_check') as check:
+                input_mtimes = [-1] + [ur['mtime'] for ur in up_results]
+                missing_files = []
+                for inf in self.input_files:
+                    try:
+                        input_mtimes.append(walk.stats.mtime(inf))
+                    except OSError:
+                        if str(inf) in walk.pending_files:  # Being saved right now
+                            input_mtimes.append(time.time())
+                        else:
+                            missing_files.append(inf)
+                output_mtime = self._output_mtime(walk.stats)
+
+                # Run task if missing outputs, stale outputs, or an upstream task has been re-run.
+                # Note that missing *inputs* do not trigger a run, which would presumably fail.
+                # This is to prevent a scenario in which the user deletes an obscure input file,
+                # asks for a downstream value, thus inadvertently wipes the entire chain of stored values,
+                # and has no way to recompute anything.
+                stale = force or output_mtime == -1 or \
+                            (output_mtime is not None and output_mtime < max(input_mtimes)) or \
+                            not result['all_current']
+                if self.tasker.staleness == 'hash' and not force and \
+                        output_mtime is not None and output_mtime != -1:
+                    # Only changed input *contents* count. By the time we get here with
+                    # run=True, any upstream tasks have already been re-run.
+                    walk.flush()
+                    hash_current = self._hash_current(result['all_current'], run,
+                                                      walk.stats)
+                    if hash_current is not None:
+                        stale = not hash_current
+                        result['all_current'] = hash_current
+                    elif not stale:  # First look at an up-to-date task
+                        self.tasker.build_state.set_task_digest(
+                            self.__name__, self._input_digest(walk.stats))
+                check['stale'] = bool(stale)
+            if stale:
+                result['all_current'] = False
+                walk.needed_tasks.append(self)
                 result['done'] = False
-        else:
-            result['done'] = True
+                if run:
+                    for missing_file in missing_files:
+                        warn('Attempting to run task "%s", but required file "%s" is '
+                             'missing. Failure is likely.' % (self.__name__, missing_file))
+                    self.run(force=force)
+                    walk.stats.forget(self.output_files)
+                    if self.tasker.write_behind and self.output_files:
+                        walk.pending_files.update(map(str, self.output_files))
+                        output_mtime = time.time()
+                    else:
+                        output_mtime = self._output_mtime(walk.stats)
+                    if self.tasker.staleness == 'mtime' and output_mtime is not None \
+                            and output_mtime < max(input_mtimes):
+                        raise RuntimeError('Task "%s" failed to update its output files.'
+                                           % self.__name__)
+            elif output_mtime is None and (  # This task does not store its outputs, and
+                missing_files  # It reads files that are missing, or
+                or not all(ur['done'] for ur in up_results)):  # It depends on tasks that are not computed
+                    result['done'] = False
+            else:
+                result['done'] = True
 
         if output_mtime is None:
             result['mtime'] = max(input_mtimes)  # No outputs
         else:
             result['mtime'] = output_mtime
+        walk.results[self] = result
         return result  # needed_tasks, visited_tasks, missing_files, all_current, mtime
 
+    @contextlib.contextmanager
+    def _exclusive(self, walk, run):
+        """Hold this task's run lock, if 'run', so that passes in other
+        threads (e.g. from Tasker.gather()) that need this task run it once.
+
+        A pass that had to wait for another then looks afresh at this
+        task's outputs, once they are saved.
+        """
+        if not run:
+            yield
+            return
+        lock = self._run_lock
+        if not lock.acquire(False):
+            lock.acquire()
+            saving = self._last_saving
+            if saving is not None:
+                futures.wait([saving])
+            walk.stats.forget(self.output_files)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _closure(self):
+        """This task and all tasks upstream of it, each listed once."""
+        tasks, stack = [], [self]
+        while stack:
+            t = stack.pop()
+            if t not in tasks:
+                tasks.append(t)
+                stack.extend(t.input_tasks)
+        return tasks
+
+    def _status_key(self, closure):
+        """Fingerprint of the task definitions that status records depend on."""
+        desc = sorted([str(t.p), t.__name__, t.tasker.staleness,
+                       sorted(map(str, t.input_files)),
+                       sorted(map(str, t.output_files))] for t in closure)
+        return hashlib.sha1(json.dumps(desc).encode('utf-8')).hexdigest()
+
+    def _status(self):
+        """Return (done, needed_tasks) as reported by _walk_up().
+
+        If the tasker's 'cache_status' is set, the answer is looked up in the
+        build state database, and is only worked out afresh if the record is
+        missing, if any file it depends on has changed, or if the tasks
+        themselves have been redefined.
+        """
+        if not self.tasker.cache_status:
+            result = self._walk_up()
+            return result['done'], result['needed_tasks']
+        closure = self._closure()
+        key = self._status_key(closure)
+        filenames = sorted(set(str(f) for t in closure
+                               for f in t.input_files + t.output_files))
+        walk = _WalkPass()
+        walk.stats.prefetch(filenames)
+        files = dict((fn, stat_signature(walk.stats.stat(fn))) for fn in filenames)
+        state = self.tasker.build_state
+        try:
+            record = state.task_status(self.__name__)
+        except (sqlite3.Error, ValueError):
+            record = None  # Unreadable database
+        if record is not None and record[0] == key and record[1] == files:
+            by_name = dict(((str(t.p), t.__name__), t) for t in closure)
+            try:
+                return record[2], [by_name[tuple(n)] for n in record[3]]
+            except KeyError:
+                pass  # Inconsistent record
+        # Work it out, and remember for next time
+        result = self._walk_up(walk=walk)
+        try:
+            state.set_task_status(self.__name__, key, files, result['done'],
+                    [[str(t.p), t.__name__] for t in result['needed_tasks']])
+        except sqlite3.Error as e:
+            warn('Could not record status of "%s" in %s: %s'
+                 % (self.__name__, state.filename, e))
+        return result['done'], result['needed_tasks']
+
     # Public interface
     def __call__(self):
         """Update outputs if necessary and read from disk. 
@@ -345,7 +789,7 @@ class TaskUnit(object):
         self.sync()
         return self.load()
 
-    def load(self):
+    def load(self, lazy=False):
         """Return representation of task output on disk.
 
         Structure is the same as in the task definition --- a single
@@ -354,26 +798,159 @@ class TaskUnit(object):
         Where a FileBase instance was used (i.e. a recognized file format like JSON()),
         the contents of the file are returned. Otherwise, the path to the file is
         returned.
+
+        If 'lazy', each file's contents are instead represented by a
+        LazyOutput, which reads the file only when it is first used.
         """
+        if lazy:
+            return self.select(lazy=True).read()
         # We return a dict in which the values are referred to by various names,
         # the wame way we pass input data to self.func() itself.
         return _nestmap(self._prepare_data, self._outs_as_given)
 
-    def run(self):
+    def run(self, force=False):
         """Execute task (always) and write output files in recognized formats.
 
-        Does not update dependencies.
+        Does not update dependencies. 'force' makes no difference here; see
+        ShardedTaskUnit.run().
 
-        Temporarily changes to task's working directory.
+        Temporarily changes to task's working directory (unless the tasker
+        has chdir=False).
 
         Status information is written to "taskerstatus.json" in this
         directory. If this file already indicates a "working" status,
         raises a LockException.
+
+        During a sync, if the tasker has 'handoff' or 'write_behind' set,
+        the outputs are passed directly to downstream tasks, and with
+        'write_behind' they are saved on a background thread.
+
+        If the tasker has an 'artifact_cache' that already holds outputs
+        computed from the same inputs, those are used instead.
+        """
+        with self._accounting() as acct:
+            self._run(acct)
+
+    def _run(self, acct):
+        walk = getattr(_active, 'walk', None)
+        defer = walk is not None and self.tasker.write_behind
+        artifacts = self.tasker.artifact_cache if self.output_files else None
+        if walk is not None and (self.tasker.staleness == 'hash' or artifacts):
+            walk.flush()
+        if self.tasker.staleness == 'hash':
+            input_digest = self._input_digest()
+            # Until we succeed, outputs cannot be trusted
+            self.tasker.build_state.set_task_digest(self.__name__, None)
+        hit = False
+        if artifacts is not None:
+            artifact_key = self._artifact_key()
+            for fn in self.output_files:
+                read_cache.discard(fn)
+            newer_than = None  # Outputs' mtimes matter for staleness
+            if self.tasker.staleness == 'mtime':
+                newer_than = -1
+                for fn in self._signature_files():
+                    try:
+                        newer_than = max(newer_than, os.stat(fn).st_mtime)
+                    except OSError:
+                        pass
+            hit = artifacts.fetch(artifact_key, self.output_files, newer_than)
+        saving = None
+        if hit:
+            acct['outcome'] = 'cached'
+        else:
+            saving = acct['deferred'] = self._run_func(walk, defer)
+        self._last_saving = saving
+        def finished(fcn, *args):
+            if saving is not None:  # Only once the outputs are really there
+                walk.writer.submit_after(saving, fcn, *args)
+            else:
+                fcn(*args)
+        if artifacts is not None and not hit:
+            finished(artifacts.store, artifact_key, self.output_files)
+        if self.tasker.staleness == 'hash':
+            finished(self.tasker.build_state.set_task_digest,
+                     self.__name__, input_digest)
+        if self.tasker.cache_status:
+            finished(self._record_last_run)
+
+    def _record_last_run(self):
+        """Note the end of a successful run in the build state, if possible."""
+        state = self.tasker.build_state
+        try:
+            state.set_last_run(self.__name__, time.time())
+        except sqlite3.Error as e:
+            # The outputs are saved; only last_run() will be out of date.
+            warn('Could not record run of "%s" in %s: %s'
+                 % (self.__name__, state.filename, e))
+
+    @contextlib.contextmanager
+    def _span(self, event, **info):
+        """Tell the tasker's hooks that 'event' begins, then that it has ended.
+
+        Yields the dict of 'info' passed to the hooks, to which the body
+        may add information for the end of the event.
+        """
+        hooks = list(self.tasker.hooks)  # Every hook that is told "begin" hears "end"
+        if not hooks:
+            yield info
+            return
+        for hook in hooks:
+            hook(event, 'begin', self, info)
+        try:
+            yield info
+        except:
+            info['error'] = True
+            raise
+        finally:
+            for hook in hooks:
+                hook(event, 'end', self, info)
+
+    @contextlib.contextmanager
+    def _accounting(self):
+        """Record the resources used by a run, if the tasker's 'record_runs' is set.
+
+        Yields a dict in which the run can set 'outcome' (default "done"), and
+        'deferred' to the Future of its outputs' saves, if they are still
+        being saved.
+        """
+        if not self.tasker.record_runs:
+            yield {}
+            return
+        meter = ResourceMeter().start()
+        acct = {'outcome': 'done'}
+        try:
+            yield acct
+        except:
+            self._record_run(meter.stop(), 'error')
+            raise
+        measured = meter.stop()
+        saving = acct.get('deferred')
+        if saving is not None:  # Output sizes (and success) are not known yet
+            def record():
+                outcome = acct['outcome'] if saving.exception() is None else 'error'
+                self._record_run(measured, outcome)
+            _active.walk.writer.submit(record)
+        else:
+            self._record_run(measured, acct['outcome'])
+
+    def _record_run(self, measured, outcome):
+        record = dict(measured, task=self.__name__, outcome=outcome,
+                      input_bytes=total_size(self._signature_files()),
+                      output_bytes=total_size(self.output_files))
+        record_run(self.p, record)
+
+    def _run_func(self, walk, defer):
+        """Call the task function, and save or hand off its outputs, for run().
+
+        Returns a Future for the saves, if they were deferred to the
+        background writer, or else None.
         """
         with tasker_traceback(self.__name__, self.tasker.p), \
                 self as ins:
             try:
-                outdata = self.func(self, ins)
+                with self._span('func'):
+                    outdata = self.func(self, ins)
             except:
                 # Hide run() in the call stack
                 if debug.EDIT_TRACEBACKS:
@@ -388,17 +965,176 @@ class TaskUnit(object):
                 elif len(outdata) != len(self.outs):
                     raise RuntimeError('Expected %i output values '
                         'but got %i.' % (len(self.outs), len(self.outdata)))
-                for of, od in zip(self.outs, outdata):
-                    if isinstance(of, FileBase): of.save(od)
+                if any(map(is_stream, outdata)):
+                    defer = False  # Saving runs the rest of the task
+                elif walk is not None and (self.tasker.handoff or defer):
+                    walk.handoff[self] = self._handoff_data(outdata)
+                groups = _group_outputs(zip(self.outs, outdata))
+                if defer:
+                    self._deferred_saves = groups  # Submitted by __exit__()
+                else:
+                    for group in groups:
+                        self._save_outputs(group)
+        saving, self._saving = self._saving, None
+        return saving
+
+    # asyncio interface (Python 3 only)
+    if _async is not None:
+        async_call = _async.async_call
+        async_sync = _async.async_sync
+        async_load = _async.async_load
+
+    def _save_outputs(self, items):
+        """Save (FileBase, data) pairs that all refer to one file."""
+        filepath = items[0][0].filepath
+        read_cache.discard(filepath)
+        with self._span('save', filename=str(filepath)):
+            artifacts = self.tasker.artifact_cache
+            if artifacts is not None and artifacts.owns(filepath):
+                os.unlink(filepath)  # Don't overwrite the cache's copy
+            try:
+                before = stat_signature(os.stat(filepath))
+            except OSError:
+                before = None
+            try:
+                type(items[0][0]).save_together(items)
+            except:
+                # Leave no partly written file to be mistaken for current
+                try:
+                    if stat_signature(os.stat(filepath)) != before:
+                        os.unlink(filepath)
+                except OSError:
+                    pass
+                raise
+
+    def _handoff_data(self, outdata):
+        """Arrange values returned by 'func' like the result of load()."""
+        given = dict((id(of), od) for of, od in zip(self.outs, outdata))
+        def prepare(part):
+            if isinstance(part, FileBase) and id(part) in given:
+                return given[id(part)]
+            return self._prepare_data(part)
+        return _nestmap(prepare, self._outs_as_given)
+
+    def select(self, lazy=False, **read_kw):
+        """Refer to this task's outputs, read with extra arguments.
+
+        For use in the inputs of another task. Each output file in a
+        recognized format is read with read(**read_kw), which lets formats
+        such as Parquet read only what is needed, e.g.
+
+            @task.stores(JSON('mean_x.json'))
+            def mean_x(tsk, x=tracks.select(columns=['x'])):
+                return x.x.mean()
+
+        If 'lazy', each file is represented by a LazyOutput (see load()), so
+        that a task using only some of the outputs reads only those files.
+        """
+        if not self.output_files:
+            raise ValueError('Task "%s" does not store outputs to select from.'
+                             % self.__name__)
+        return _Selection(self, read_kw, lazy)
 
     def force(self):
         """Re-run task and return outputs."""
         self._walk_up(run=True, force=True)
         return self.load()
 
-    def sync(self):
-        """Update dependencies, and this task, as needed."""
-        self._walk_up(run=True)
+    def sync(self, workers=None, threads=False):
+        """Update dependencies, and this task, as needed.
+
+        workers : if greater than 1, run out-of-date tasks in as many as
+            this many child processes at once. Each task is started as soon
+            as the tasks it depends on have finished, so that independent
+            branches of the pipeline run concurrently. Requires os.fork().
+        threads : if true, use threads instead of child processes. This
+            suits tasks that mostly wait on I/O. All taskers involved must
+            have been created with chdir=False.
+        """
+        if workers is not None and workers > 1:
+            self._run_parallel(workers, threads)
+        self._walk_up(run=True)  # Verifies, and finishes anything left over
+
+    def _run_parallel(self, workers, threads=False):
+        """Run the out-of-date tasks found by _walk_up() concurrently.
+
+        Tasks are started in dependency order, at most 'workers' at a time,
+        in child processes or (if 'threads') in a thread pool.
+        Non-storing tasks are skipped, since run() does nothing for them.
+        If any task fails, no new tasks are started, and RuntimeError is
+        raised once the running ones have finished.
+        """
+        if not threads and not hasattr(os, 'fork'):
+            warn('Parallel sync requires os.fork(); running tasks serially.')
+            return
+        needed = _uniq(self._walk_up()['needed_tasks'])  # Dependency order
+        if threads:
+            chdirs = [t for t in needed if t.tasker.chdir]
+            if chdirs:
+                raise ValueError('Cannot run tasks in threads unless their taskers '
+                                 'have chdir=False: %s' % ', '.join(
+                                    '"%s"' % t.__name__ for t in chdirs))
+            pool = futures.ThreadPoolExecutor(workers)
+            start = lambda tsk: pool.submit(tsk.run)
+            def wait(handles):
+                done = futures.wait(handles, return_when=futures.FIRST_COMPLETED)[0]
+                return [(f, f.exception()) for f in done]
+        else:
+            ctx = multiprocessing.get_context('fork')
+            procs = {}  # Process sentinel -> process
+            def start(tsk):
+                proc = ctx.Process(target=tsk.run, name='tasker-' + tsk.__name__)
+                proc.start()
+                procs[proc.sentinel] = proc
+                return proc.sentinel
+            def wait(handles):
+                ret = []
+                for sentinel in multiprocessing.connection.wait(handles):
+                    proc = procs.pop(sentinel)
+                    proc.join()
+                    ret.append((sentinel, proc.exitcode or None))
+                return ret
+        waiting = OrderedDict((t, set(it for it in t.input_tasks if it in needed))
+                              for t in needed)
+        running = {}  # Future or process sentinel -> task
+        failed = []
+
+        def finished(tsk):
+            for deps in waiting.values():
+                deps.discard(tsk)
+
+        try:
+            while waiting or running:
+                started = True
+                while started and not failed and len(running) < workers:
+                    started = False
+                    for tsk in [t for t, deps in waiting.items() if not deps]:
+                        if len(running) >= workers:
+                            break
+                        del waiting[tsk]
+                        started = True
+                        if isinstance(tsk, TaskUnitNoStore):
+                            finished(tsk)
+                        else:
+                            running[start(tsk)] = tsk
+                if not running:
+                    break  # Failed, or nothing left that can run
+                for handle, error in wait(list(running)):
+                    tsk = running.pop(handle)
+                    if error is None:
+                        finished(tsk)
+                    else:
+                        failed.append((tsk, error))
+        finally:
+            if threads:
+                pool.shutdown()
+        if failed:
+            err = RuntimeError('Task(s) failed in worker %s: %s'
+                               % ('threads' if threads else 'processes',
+                                  ', '.join('"%s"' % t.__name__ for t, e in failed)))
+            if threads:
+                six.raise_from(err, failed[0][1])
+            raise err
 
     def is_current(self):
         """True if this task's output is readily available.
@@ -410,11 +1146,18 @@ class TaskUnit(object):
         If the task does not store its output, this implies that all
         its dependencies are available and current.
         """
-        return self._walk_up()['done']
+        return self._status()[0]
 
     def report(self):
         """List tasks that would have to be run to update outputs."""
-        return _uniq(self._walk_up()['needed_tasks'])
+        return _uniq(self._status()[1])
+
+    def last_run(self):
+        """time.time() when this task last ran successfully, or None.
+
+        Only recorded if the tasker's 'cache_status' is set.
+        """
+        return self.tasker.build_state.last_run(self.__name__)
 
     def clear(self):
         """Delete this task's output files and directories."""
@@ -430,14 +1173,15 @@ class TaskUnitNoStore(TaskUnit):
     def __init__(self, func, ins, tasker):
         super(TaskUnitNoStore, self).__init__(func, ins, [], tasker)
 
-    def run(self):
+    def run(self, force=False):
         """Does nothing, as there is nothing on disk to update."""
         pass
 
     def __call__(self):
         """Run task and return its output, after updating dependencies.
 
-        Temporarily changes to task's working directory.
+        Temporarily changes to task's working directory (unless the tasker
+        has chdir=False).
 
         Status information is written to "taskerstatus.json" in this
         directory. If this file already indicates a "working" status,
@@ -446,7 +1190,7 @@ class TaskUnitNoStore(TaskUnit):
         self.sync()
         try:
             with tasker_traceback(self.__name__, self.tasker.p), \
-                    self as ins:
+                    self as ins, self._span('func'):
                 return self.func(self, ins)
         except:
             # Hide __call__() in the call stack
@@ -456,24 +1200,299 @@ class TaskUnitNoStore(TaskUnit):
             else:
                 raise
 
-    load = __call__
     force = __call__
 
+    def load(self, lazy=False):
+        """Same as calling the task. (There are no stored outputs to be lazy about.)"""
+        return self()
+
     def clear(self):
         raise NotImplementedError("This task has no stored "
                     "outputs to clear. You must call clear() for each "
                     "storing task that depends on it.")
 
 
+class ShardedTaskUnit(TaskUnit):
+    """A task whose output is divided into shards, one for each of 'keys'.
+
+    Ordinarily created with Tasker.shards().
+
+    Each shard is stored in its own files, named by formatting the names in
+    'outs' with the shard's key (e.g. "features_{key}.json"), and is computed
+    by its own call to 'func'. 'shard_ins', if given, is a function of the
+    key that returns the files (or FileBase instances, or a list or dict of
+    them) used by that shard alone.
+
+    'func' is called as func(tsk, key, shard_in, ins), where 'shard_in' is
+    the prepared result of shard_ins(key) (or None), and 'ins' is prepared as
+    for any other task. It returns the shard's outputs.
+
+    Staleness is decided shard by shard: a shard is out of date if its
+    outputs are missing or older than its own inputs or the shared ones
+    (or, with "hash" staleness, if their contents have changed since it
+    was computed). Only those shards are recomputed, in as many as 'workers'
+    threads at once. load() returns a dict of the shards' outputs, by key.
+
+    Outputs are saved as each shard finishes; they are not handed off to
+    downstream tasks in memory.
+    """
+    def __init__(self, func, ins, outs, tasker, keys, shard_ins=None, workers=None):
+        self.keys = list(keys)
+        if not self.keys:
+            raise ValueError('A sharded task needs at least one key.')
+        self.p = tasker.p
+        templates = _listify(outs)
+        self.shard_outs = OrderedDict(
+            (k, [self._shard_output(o, k) for o in templates]) for k in self.keys)
+        super(ShardedTaskUnit, self).__init__(
+            func, ins, [o for so in self.shard_outs.values() for o in so], tasker)
+        if isinstance(outs, (list, tuple)):
+            self._outs_as_given = self.shard_outs
+        else:
+            self._outs_as_given = OrderedDict((k, so[0])
+                                              for k, so in self.shard_outs.items())
+        if len(set(self.output_files)) != len(self.output_files):
+            raise ValueError('Output filenames of task "%s" must include "{key}", '
+                             'so that each shard has its own.' % self.__name__)
+        self.workers = workers
+        self.shard_ins = OrderedDict()
+        self.shard_input_files = OrderedDict()
+        for k in self.keys:
+            spec = _nestmap(self._rectify_input,
+                            shard_ins(k) if shard_ins is not None else [])
+            self.shard_ins[k] = spec if shard_ins is not None else None
+            self.shard_input_files[k] = list(map(self._get_filename,
+                    self._flatten_dependencies_recurse(spec)))
+        self.shared_input_files = self.input_files
+        self.input_files = _uniq(self.shared_input_files + [f
+                for files in self.shard_input_files.values() for f in files])
+
+    def _shard_output(self, template, key):
+        if isinstance(template, FileBase):
+            return template._renamed(str(template.filename).format(key=key))
+        return str(template).format(key=key)
+
+    def _rectify_input(self, part):
+        if isinstance(part, FileBase):
+            part.set_parentdir(self.p)
+        elif isinstance(part, (TaskUnit, _Selection)):
+            raise ValueError('Inputs of individual shards must be files, not tasks.')
+        return part
+
+    def _shard_name(self, key):
+        """Name under which a shard's input signature is recorded."""
+        return '%s[%s]' % (self.__name__, key)
+
+    def _signature_files(self):
+        shard_files = set(f for files in self.shard_input_files.values()
+                          for f in files)
+        return [f for f in super(ShardedTaskUnit, self)._signature_files()
+                if f not in shard_files]
+
+    def _shard_digest(self, key, stats=None):
+        return self.tasker.build_state.files_digest(
+            self._signature_files() + self.shard_input_files[key], stats=stats)
+
+    def _stale_keys(self, stats=None):
+        """Keys of the shards that are missing or out of date."""
+        if stats is None:
+            stats = StatCache()
+        def newest(files):
+            mtimes = [-1]
+            for f in files:
+                try:
+                    mtimes.append(stats.mtime(f))
+                except OSError:
+                    pass  # Missing inputs do not make a shard stale
+            return max(mtimes)
+        hashing = self.tasker.staleness == 'hash'
+        shared_mtime = newest(self._signature_files())
+        stale = []
+        for k in self.keys:
+            try:
+                out_mtime = min([stats.mtime(self._get_filename(of))
+                                 for of in self.shard_outs[k]])
+            except OSError:
+                stale.append(k)
+                continue
+            if hashing:
+                recorded = self.tasker.build_state.task_digest(self._shard_name(k))
+                if recorded is not None:
+                    if recorded != self._shard_digest(k, stats):
+                        stale.append(k)
+                    continue
+            if out_mtime < max(shared_mtime, newest(self.shard_input_files[k])):
+                stale.append(k)
+        return stale
+
+    def _output_mtime(self, stats=None):
+        """Newest modification time of output files, or -1 if any shard is stale."""
+        if self._stale_keys(stats):
+            return -1
+        return super(ShardedTaskUnit, self)._output_mtime(stats)
+
+    def _hash_current(self, up_current, run, stats=None):
+        if not (run or up_current):
+            return None
+        return True  # Shards were already checked, by _output_mtime()
+
+    def run(self, force=False):
+        """Compute the shards that are out of date (or all of them, if none
+        are, or if 'force').
+
+        Otherwise like TaskUnit.run().
+        """
+        with self._accounting():
+            self._run_shards(force)
+
+    def _run_shards(self, force=False):
+        walk = getattr(_active, 'walk', None)
+        if walk is not None:
+            walk.flush()  # Inputs must be on disk
+        keys = self.keys if force else (self._stale_keys() or self.keys)
+        state = self.tasker.build_state
+        hashing = self.tasker.staleness == 'hash'
+        with tasker_traceback(self.__name__, self.tasker.p), \
+                self as ins:
+            def run_shard(key):
+                if hashing:
+                    digest = self._shard_digest(key)
+                    state.set_task_digest(self._shard_name(key), None)
+                shard_in = self.shard_ins[key]
+                if shard_in is not None:
+                    shard_in = _nestmap(self._prepare_data, shard_in)
+                with self._span('func', key=key):
+                    outdata = self.func(self, key, shard_in, ins)
+                outs = self.shard_outs[key]
+                if len(outs) == 1:
+                    outdata = [outdata,]
+                elif len(outdata) != len(outs):
+                    raise RuntimeError('Expected %i output values for shard %r '
+                        'but got %i.' % (len(outs), key, len(outdata)))
+                for group in _group_outputs(zip(outs, outdata)):
+                    self._save_outputs(group)
+                if hashing:
+                    state.set_task_digest(self._shard_name(key), digest)
+            if self.workers is not None and self.workers > 1:
+                pool = futures.ThreadPoolExecutor(self.workers)
+                try:
+                    for i, _ in enumerate(pool.map(run_shard, keys)):
+                        self.progress.working(i + 1, len(keys))
+                finally:
+                    pool.shutdown()
+            else:
+                for i, key in enumerate(keys):
+                    run_shard(key)
+                    self.progress.working(i + 1, len(keys))
+        if self.tasker.cache_status:
+            self._record_last_run()
+
+
 class Tasker(DirBase):
     """Object to set up tasks within a single directory.
     
-    Initialize with the directory name."""
-    def __init__(self, dirname='.'):
+    Initialize with the directory name.
+
+    'staleness' chooses how tasks decide whether their stored outputs are
+    out of date:
+        "mtime" : (default) if any input file is newer than the outputs.
+        "hash" : if the contents of the input files have changed since the
+            task last ran. Merely touching or re-copying an input does not
+            cause a re-run. File hashes are cached in a database in this
+            directory (see build_state), so unchanged files are not re-read.
+            Where nothing has been recorded yet, modification times are used.
+
+    If 'cache_status' is true, the results of is_current() and report()
+    (and therefore menu()) are remembered in the build_state database, along
+    with the size and modification time of each file they depend on. Later
+    queries only need to check that those files are unchanged. Successful
+    runs are also recorded (see TaskUnit.last_run()).
+
+    If 'chdir' is false, tasks do not change the process's working directory
+    while they run. Task functions must then find files through 'tsk.p' or
+    their inputs, but tasks in different directories can run on threads
+    in the same process (see TaskUnit.sync()).
+
+    If 'handoff' is true, when a task runs during a sync, the values it
+    returns are given directly to the downstream tasks that need them, rather
+    than being read back from disk. (They are not round-tripped through the
+    file format, so e.g. tuples saved as JSON stay tuples.) If 'write_behind'
+    is true, outputs are handed off in the same way, and are saved on a
+    background thread while the sync goes on; all saves are finished before
+    sync() returns. Downstream tasks must not modify the values they are given.
+
+    'status_interval' : while a task runs, progress reports (from
+    tsk.progress.tally() or working()) are written to the status file at
+    most once in this many seconds (default 1; 0 writes every report).
+    Changes of status are written at once.
+    If 'status_background' is true, the reports are written on a thread.
+    'status_store' is a central store (see tasker.statusdb) that receives
+    every status update too, or a description such as "sqlite:PATH".
+
+    If 'record_runs' is true, each run of a task is recorded in the file
+    ".taskerruns.jsonl" in this directory, with the time and memory it took
+    and the sizes of its inputs and outputs. See profile().
+
+    'artifact_cache' is an optional ArtifactCache, which may be shared with
+    taskers in other directories. Tasks that store their outputs then take
+    them from the cache, where possible, instead of running. Sharded tasks
+    do not use it. Input files are identified by their contents, whose
+    hashes are kept in the build_state database even with "mtime" staleness.
+
+    Functions in 'hooks' are told what each task is doing; see add_hook().
+    """
+    def __init__(self, dirname='.', staleness='mtime', cache_status=False,
+                 chdir=True, handoff=False, write_behind=False,
+                 artifact_cache=None, status_interval=1, status_background=False,
+                 status_store=None, record_runs=False):
         super(Tasker, self).__init__(dirname)
+        if staleness not in ('mtime', 'hash'):
+            raise ValueError('Unknown staleness mode "%s"' % staleness)
+        self.staleness = staleness
+        self.cache_status = cache_status
+        self.chdir = chdir
+        self.handoff = handoff
+        self.write_behind = write_behind
+        self.artifact_cache = artifact_cache
+        self.status_interval = status_interval
+        self.status_background = status_background
+        self.status_store = open_status_store(status_store)
+        self.record_runs = record_runs
+        self.hooks = []
         self.tasks = OrderedDict()
         self.conf = AttrDict()
 
+    def add_hook(self, hook):
+        """Call 'hook' at the beginning and end of each step of running a task.
+
+        It is called as hook(event, phase, task, info), where 'phase' is
+        "begin" or "end", 'task' is the TaskUnit, and 'info' is a dict with
+        any details. The events are
+            "stale_check" : deciding whether the task must run. At the end,
+                info['stale'] gives the answer.
+            "lock_wait" : taking the task's lock, or (for tasks called from
+                asyncio) waiting for other tasks to leave the working directory.
+            "load_inputs" : reading the task's inputs.
+            "func" : the task function. For sharded tasks, once per shard,
+                with info['key'].
+            "save" : saving an output file, info['filename']. With
+                write_behind, this happens on a background thread.
+        If the step fails, info['error'] is True at the end.
+
+        Hooks are called on whichever thread does the work, so they must be
+        quick and thread-safe. See tasker.trace.TraceRecorder.
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @cachedprop
+    def build_state(self):
+        """BuildState database for this directory."""
+        return BuildState(self.p / DEFAULT_STATE_FILE)
+
     def create_task(self, ins, outs):
         """Return a decorator that turns the function into a task
         with registered inputs and outputs.
@@ -494,6 +1513,9 @@ class Tasker(DirBase):
             return t
         return mktask
 
+    if _async is not None:  # Python 3 only
+        gather = staticmethod(_async.gather)
+
     def stores(self, *outputs):
         """Create a task that stores outputs in the specified files.
 
@@ -547,6 +1569,72 @@ class Tasker(DirBase):
             return t
         return mktask
 
+    def shards(self, keys, *outputs, **kw):
+        """Create a task whose output is divided into shards, one per key.
+
+        'keys' is the key space (e.g. frame numbers or segment names).
+        'outputs' are like those of stores(), except that each filename must
+        contain "{key}", to be formatted with the shard's key.
+        'inputs', if given, is a function that takes a key and returns the
+        files used by that shard alone (see ShardedTaskUnit).
+        'workers' : number of threads in which to compute shards at once.
+
+        The task function is called once per shard, as func(tsk, key, **ins),
+        or func(tsk, key, shard_in, **ins) if 'inputs' is given, e.g.
+
+            @tasker.shards(range(500), JSON('features_{key}.json'),
+                           inputs=lambda key: 'segments/seg%03i.tif' % key)
+            def features(tsk, key, segment, params=tasker.params):
+                ...
+
+        Only the shards whose outputs are missing or out of date are
+        recomputed. See ShardedTaskUnit for details.
+        """
+        inputs, workers = kw.pop('inputs', None), kw.pop('workers', None)
+        if kw:
+            raise TypeError('Unexpected arguments: %s' % ', '.join(sorted(kw)))
+        if not outputs:
+            raise ValueError('A sharded task must store its outputs.')
+        if len(outputs) == 1:
+            outputs = outputs[0]
+
+        def rectify_filepath(iospec):
+            if isinstance(iospec, FileBase):
+                iospec.set_parentdir(self.p)
+            return iospec
+
+        def mktask(func):
+            args, _, _, defaults = inspect.getargspec(func)
+            if defaults is None: defaults = ()
+            npos = 2 if inputs is None else 3
+            if len(args) - len(defaults) != npos:
+                raise RuntimeError('Sharded task function must take %i arguments '
+                                   'without default values (%s); the rest are its '
+                                   'inputs.' % (npos, 'tsk, key' if inputs is None
+                                                else 'tsk, key, shard_in'))
+            ins = dict(zip(args[npos:], defaults))
+            @functools.wraps(func)
+            def shard_func_with_kw(tsk, key, shard_in, ins):
+                try:
+                    if inputs is None:
+                        return func(tsk, key, **ins)
+                    return func(tsk, key, shard_in, **ins)
+                except:
+                    # Hide this wrapper function in the call stack
+                    if debug.EDIT_TRACEBACKS:
+                        typ, val, tb = sys.exc_info()
+                        six.reraise(typ, val, tb.tb_next)
+                    else:
+                        raise
+
+            t = ShardedTaskUnit(shard_func_with_kw, _nestmap(rectify_filepath, ins),
+                                _nestmap(rectify_filepath, outputs), self, keys,
+                                shard_ins=inputs, workers=workers)
+            self.tasks[t.__name__] = t
+            setattr(self, t.__name__, t)
+            return t
+        return mktask
+
     def computes(self, func):
         """Decorator that creates a task without stored outputs."""
         return self.stores()(func)
@@ -570,21 +1658,29 @@ class Tasker(DirBase):
             if not isinstance(t, TaskUnitNoStore):
                 t.clear()
 
+    def run_history(self):
+        """DataFrame of recorded task runs (see 'record_runs'), oldest first."""
+        return read_runs(self.p)
+
+    def profile(self):
+        """Summary of recorded task runs, by task, most expensive first.
+
+        See accounting.summarize() for the columns.
+        """
+        return summarize(self.run_history())
+
     def is_working(self, task=None):
-        """Check "taskerstatus.json" to see if any task is running.
+        """Check the lockfiles in this directory to see if any task is running.
 
         task : Check whether task with this name is running (optional).
+
+        Tasks in one directory share "taskerstatus.json", so it may show a
+        sibling as "done" while this task runs. Each task holds its own lock.
         """
-        try:
-            sf = open(self.p / DEFAULT_STATUS_FILE, 'r')
-            sfinfo = json.load(sf)
-            if sfinfo['status'] == 'working':
-                if task is not None:
-                    return self._lockfile(task).exists()
-                else:
-                    return True
-        except (IOError, ValueError, KeyError):
-            return False
+        if task is not None:
+            return self._lockfile(task).exists()
+        lfd = self.p / DEFAULT_STATUS_DIR
+        return lfd.isdir() and bool(lfd.files())
 
     def _lockfile(self, taskname):
         """Returns path instance for task-specific lockfile"""
@@ -0,0 +1,98 @@
+import os, time
+import tempfile, unittest
+from path import Path
+from tasker import task, storage
+from tasker.artifacts import ArtifactCache
+basedir = Path.getcwd()
+
+class artifacttests(unittest.TestCase):
+    def setUp(self):
+        os.chdir(basedir)
+        self.testdir = Path(tempfile.mkdtemp())
+        self.cache = ArtifactCache(self.testdir / 'cache')
+        self.runs = []
+    def tearDown(self):
+        os.chdir(basedir)
+        self.testdir.rmtree()
+    def make_tasker(self, name, calibration='1.5'):
+        dirname = self.testdir / name
+        dirname.makedirs_p()
+        (dirname / 'calib.txt').write_text(calibration)
+        past = time.time() - 1000  # Older than anything in the cache
+        os.utime(dirname / 'calib.txt', (past, past))
+        tkr = task.Tasker(dirname, artifact_cache=self.cache)
+        runs = self.runs
+        @tkr.stores(storage.JSON('calibrated.json'))
+        def calibrated(tsk, calib='calib.txt'):
+            runs.append(str(tsk.p.name))
+            return float(calib.text()) * 2
+        return tkr
+    def test_shared(self):
+        a, b = self.make_tasker('a'), self.make_tasker('b')
+        self.assertEqual(a.calibrated(), 3.0)
+        self.assertEqual(b.calibrated(), 3.0)
+        self.assertEqual(self.runs, ['a'])
+        assert b.calibrated.is_current()
+        c = self.make_tasker('c', calibration='2')
+        self.assertEqual(c.calibrated(), 4.0)
+        self.assertEqual(self.runs, ['a', 'c'])
+        # Rewriting a materialized output leaves the cached copy alone
+        b.calibrated.outs[0].save(0)
+        d = self.make_tasker('d')
+        self.assertEqual(d.calibrated(), 3.0)
+        self.assertEqual(self.runs, ['a', 'c'])
+    def test_hardlink(self):
+        self.cache.hardlink = True
+        a, b = self.make_tasker('a'), self.make_tasker('b')
+        a.calibrated(), b.calibrated()
+        self.assertEqual(self.runs, ['a'])
+        self.assertEqual(os.stat(b.p / 'calibrated.json').st_nlink, 2)
+        (b.p / 'calib.txt').write_text('5')
+        self.assertEqual(b.calibrated(), 10.0)  # Output replaced, not overwritten
+        self.assertEqual(os.stat(b.p / 'calibrated.json').st_nlink, 1)
+        self.assertEqual(self.make_tasker('c').calibrated(), 3.0)
+        assert self.cache.owns(self.testdir / 'c' / 'calibrated.json')
+        assert not self.cache.owns(b.p / 'calibrated.json')
+    def test_hardlink_evicted(self):
+        self.cache.hardlink = True
+        b, c = self.make_tasker('b'), self.make_tasker('c')
+        b.calibrated(), c.calibrated()
+        self.assertEqual(self.runs, ['b'])
+        c_mtime = os.stat(c.p / 'calibrated.json').st_mtime
+        self.cache.clear()  # As by eviction; the links remain
+        (b.p / 'calib.txt').write_text('5')
+        self.assertEqual(b.calibrated(), 10.0)
+        self.assertEqual(c.calibrated.load(), 3.0)  # Not written through
+        assert c.calibrated.is_current()
+        # A link that would look older than its inputs is not made
+        cached = self.cache._entry_dir('key') / '0'
+        self.cache.store('key', [c.p / 'calib.txt'])
+        cached_mtime = os.stat(cached).st_mtime
+        assert self.cache.fetch('key', [self.testdir / 'new.txt'],
+                                newer_than=time.time() + 100)
+        self.assertEqual(os.stat(self.testdir / 'new.txt').st_nlink, 1)
+        assert self.cache.fetch('key', [self.testdir / 'linked.txt'])
+        self.assertEqual(os.stat(cached).st_nlink, 2)
+        self.assertEqual(os.stat(cached).st_mtime, cached_mtime)  # Not touched
+        self.assertEqual(os.stat(c.p / 'calibrated.json').st_mtime, c_mtime)
+    def test_user_links(self):
+        a = self.make_tasker('a')
+        a.calibrated()
+        os.link(a.p / 'calibrated.json', self.testdir / 'mine.json')
+        (a.p / 'calib.txt').write_text('5')
+        self.assertEqual(a.calibrated(), 10.0)
+        self.assertEqual(storage.JSON(self.testdir / 'mine.json').read(), 10.0)
+    def test_eviction(self):
+        cache = ArtifactCache(self.testdir / 'small', max_bytes=250)
+        for i in range(4):
+            fn = self.testdir / ('f%i' % i)
+            fn.write_bytes(b'x' * 100)
+            assert cache.store('key%i' % i, [fn])
+            if i in (1, 2):
+                assert cache.fetch('key0', [self.testdir / 'out'])  # Recently used
+        assert 'key0' in cache
+        assert 'key1' not in cache and 'key2' not in cache
+        assert 'key3' in cache
+        self.assertEqual(cache.total_bytes(), 200)
+        assert not cache.fetch('key1', [self.testdir / 'out'])
+        assert not cache.store('dir', [self.testdir])
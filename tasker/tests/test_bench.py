@@ -0,0 +1,30 @@
+import json
+import numpy
+import pandas
+from six import StringIO
+from unittest import mock
+from tasker import bench
+
+def test_bench_storage():
+    objects = {'records': [{'a': 1}, {'a': 2}],
+               'frame': pandas.DataFrame({'x': numpy.arange(5.)})}
+    results = bench.bench_storage(objects, ['JSON', 'JSONLines', 'Pickle'], repeat=2)
+    assert list(results.columns) == bench.COLUMNS
+    assert len(results) == 6
+    assert list(results.ok) == [True, True, True, False, True, True]
+    assert 'TypeError' in results.error[3]  # DataFrame is not JSON serializable
+    assert (results[results.format == 'Pickle'].roundtrip == True).all()
+    frame_jsonl = results[(results.object == 'frame') & (results.format == 'JSONLines')]
+    assert not frame_jsonl.roundtrip.iloc[0]  # Only the column names are saved
+    recs = bench.recommend(results)
+    assert recs['frame']['smallest'] == 'Pickle'
+
+def test_main_json():
+    out = StringIO()
+    with mock.patch('sys.stdout', out):
+        assert bench.main(['storage', '--size', '200', '--repeat', '1', '--json',
+                           '--formats', 'JSON', 'NumPy']) == 0
+    summary = json.loads(out.getvalue())
+    assert summary['benchmark'] == 'storage'
+    assert len(summary['results']) == 6
+    assert summary['recommendations']['array']['fastest_read'] == 'NumPy'
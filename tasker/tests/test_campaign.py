@@ -0,0 +1,57 @@
+import os
+import json
+import tempfile, unittest
+from path import Path
+from tasker import SetTasker, campaign, loader
+basedir = Path.getcwd()
+mypath = Path(__file__)
+sample_taskfile = mypath.dirname() / 'sample_taskfile.py'
+
+class campaigntests(unittest.TestCase):
+    def setUp(self):
+        os.chdir(basedir)
+        self.testdir = Path(tempfile.mkdtemp())
+        sample_taskfile.copy(self.testdir / 'taskfile_sub.py')
+        self.names = ['a', 'b', 'c', 'd']
+        for name in self.names:
+            (self.testdir / name).makedirs_p()
+        with open(self.testdir / 'groups.json', 'w') as f:
+            json.dump({'movies': self.names}, f)
+        self.settasker = SetTasker(self.testdir)
+    def tearDown(self):
+        os.chdir(basedir)
+        self.testdir.rmtree()
+    def test_run_group(self):
+        loader.use(self.testdir / 'a').three()
+        # Makes task "two" fail in this directory only
+        (self.testdir / 'c' / 'one.json').makedirs_p()
+        outcomes = self.settasker.run_group('movies', 'three', workers=2)
+        self.assertEqual(list(outcomes.dir), self.names)
+        self.assertEqual(list(outcomes.outcome), ['current', 'done', 'error', 'done'])
+        assert 'IsADirectoryError' in outcomes.error[2] or 'IOError' in outcomes.error[2]
+        assert (self.testdir / 'd' / 'three.h5').exists()
+        assert not (self.testdir / 'c' / 'three.h5').exists()
+        assert (outcomes.elapsed >= 0).all()
+    def test_serial(self):
+        outcomes = campaign.run_campaign([self.testdir / n for n in self.names],
+                                         'two', workers=1)
+        self.assertEqual(list(outcomes.outcome), ['done'] * 4)
+        outcomes = campaign.run_campaign([self.testdir / n for n in self.names],
+                                         'two', workers=1)
+        self.assertEqual(list(outcomes.outcome), ['current'] * 4)
+    def test_profile(self):
+        for name in self.names[:2]:
+            tkr = loader.use(self.testdir / name)
+            tkr.record_runs = True
+            tkr.three()
+        tkr.two.force()
+        history = campaign.run_history([self.testdir / n for n in self.names])
+        self.assertEqual(list(history.dir), ['a'] * 3 + ['b'] * 4)
+        self.assertEqual(list(history.task), ['one', 'two', 'three'] * 2 + ['two'])
+        profile = campaign.profile_campaign([self.testdir / n for n in self.names])
+        self.assertEqual(sorted(profile.index), ['one', 'three', 'two'])
+        self.assertEqual(profile.runs['two'], 3)
+        assert (profile.errors == 0).all()
+        assert (profile.mean_output_bytes > 0).all()
+        by_dir = campaign.profile_campaign([self.testdir / 'a'], by=['dir', 'task'])
+        self.assertEqual(len(by_dir), 3)
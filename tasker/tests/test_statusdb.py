@@ -0,0 +1,59 @@
+import os
+import tempfile, unittest
+from path import Path
+from tasker import task, storage, progress
+from tasker.statusdb import (SQLiteStatusStore, SocketStatusStore, StatusCollector,
+                             open_status_store)
+basedir = Path.getcwd()
+
+class statusdbtests(unittest.TestCase):
+    def setUp(self):
+        os.chdir(basedir)
+        self.testdir = Path(tempfile.mkdtemp())
+        self.dbname = self.testdir / 'status.sqlite'
+    def tearDown(self):
+        os.chdir(basedir)
+        self.testdir.rmtree()
+    def test_tasks_report(self):
+        dirs = [self.testdir / n for n in ('a', 'b', 'c')]
+        for d in dirs[:2]:
+            d.makedirs_p()
+            tkr = task.Tasker(d, status_store='sqlite:' + self.dbname,
+                              status_interval=0)  # Record every report
+            @tkr.stores(storage.JSON('counted.json'))
+            def counted(tsk):
+                for i in tsk.progress.tally(range(5)):
+                    pass
+                return i
+            counted()
+        store = SQLiteStatusStore(self.dbname)
+        stat = progress.Monitor(dirs, store=store).get_statuses()
+        self.assertEqual(list(stat.status), ['done', 'done', '?'])
+        self.assertEqual(list(stat.task[:2]), ['counted', 'counted'])
+        assert stat.since_update[0] and not stat.since_update[2]
+        hist = store.get_history(dirs[0].abspath(), 'counted')
+        self.assertEqual(list(hist.status), ['working'] * 6 + ['done'])
+        self.assertEqual(list(hist.current.fillna(0)), [0, 1, 2, 3, 4, 5, 0])
+    def test_history_limit(self):
+        store = SQLiteStatusStore(self.dbname, history=3)
+        for i in range(5):
+            store.put('/x', {'task': 't', 'current': i}, updated=i)
+            store.put('/x', {'task': 'u', 'current': i}, updated=i + 0.5)
+        self.assertEqual(list(store.get_history('/x', 't').current), [2, 3, 4])
+        self.assertEqual(len(store.get_history('/x')), 6)
+        self.assertEqual(store.latest()['/x'][1], {'task': 'u', 'current': 4})
+    def test_socket(self):
+        sockname = str(self.testdir / 'status.sock')
+        store = SQLiteStatusStore(self.dbname)
+        collector = StatusCollector(sockname, store)
+        collector.bind()
+        try:
+            client = open_status_store('unix:' + sockname)
+            assert isinstance(client, SocketStatusStore)
+            client.put('/y', {'task': 't', 'status': 'working'})
+            assert collector.handle(timeout=5)
+            self.assertEqual(store.latest(['/y'])['/y'][1]['status'], 'working')
+        finally:
+            collector.close()
+        assert not os.path.exists(sockname)
+        client.put('/y', {'status': 'done'})  # Nobody listening; no error
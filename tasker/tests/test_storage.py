@@ -1,12 +1,19 @@
 import os
+import json
 from path import Path
 
-import tempfile, shutil
+import tempfile, shutil, threading
 import unittest
 import numpy
 import pandas
 
-from tasker.storage import Pandas, Pickle, JSON
+from tasker.storage import Pandas, Pickle, JSON, JSONLines, NumPy, Parquet, is_stream
+from tasker.storage import hdf_pool, active_hdf_pool, HDFPool
+from tasker.cache import ReadCache
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 def test_Pandas():
     data = pandas.Series(numpy.random.random((100,)))
@@ -20,6 +27,91 @@ def test_Pandas():
     finally:
         os.unlink(pobj.filename)
 
+def test_Pandas_chunks():
+    chunks = [pandas.DataFrame({'a': numpy.arange(i * 10, i * 10 + 10)},
+                               index=numpy.arange(i * 10, i * 10 + 10))
+              for i in range(5)]
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        pobj = Pandas(testdir / 'chunks.h5')
+        pobj.save(iter(chunks))
+        assert list(pobj.read().a) == list(range(50))
+        pieces = list(pobj.iter_chunks(20))
+        assert [len(p) for p in pieces] == [20, 20, 10]
+        pieces = list(Pandas(testdir / 'chunks.h5', chunksize=25).read())
+        assert [len(p) for p in pieces] == [25, 25]
+        # An error partway through leaves the previous file in place
+        def broken():
+            yield chunks[0]
+            raise ValueError()
+        try:
+            pobj.save(broken())
+        except ValueError:
+            pass
+        assert len(pobj.read()) == 50
+        # So does a stream with nothing in it, which can't be read back
+        try:
+            pobj.save(iter([chunks[0][:0]]))
+        except ValueError as e:
+            assert 'No chunks' in str(e)
+        else:
+            raise AssertionError('Saved no chunks')
+        assert len(pobj.read()) == 50
+        assert os.listdir(testdir) == ['chunks.h5']
+    finally:
+        shutil.rmtree(testdir)
+
+def test_hdf_pool():
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        x = Pandas(testdir / 'both.h5', key='x')
+        y = Pandas(testdir / 'both.h5', key='y')
+        Pandas.save_together([(x, pandas.Series([1, 2])), (y, pandas.Series([3]))])
+        with hdf_pool() as pool:
+            with hdf_pool() as inner:
+                assert inner is pool
+            assert list(x.read()) == [1, 2]
+            with pool.opened(x.filepath) as store:
+                pass
+            assert list(y.read()) == [3]
+            with pool.opened(y.filepath) as ystore:
+                assert ystore is store  # Opened once
+            x.save(pandas.Series([5]))  # Writer closes the pooled handle
+            assert not store.is_open
+            assert list(x.read()) == [5]
+            assert len(pool) == 1
+        assert active_hdf_pool() is None
+        assert len(pool) == 0 and not store.is_open
+    finally:
+        shutil.rmtree(testdir)
+
+def test_hdf_pool_limit():
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        objs = [Pandas(testdir / ('f%i.h5' % i), key='x') for i in range(4)]
+        for i, obj in enumerate(objs):
+            obj.save(pandas.Series([i]))
+        pool = HDFPool(max_open=2)
+        try:
+            with pool.opened(objs[0].filepath) as first:
+                pass
+            for obj in objs[1:3]:
+                with pool.opened(obj.filepath):
+                    pass
+            assert len(pool) == 2 and not first.is_open  # Least recently used
+            with pool.opened(objs[1].filepath) as second:
+                pool_thread = threading.Thread(target=pool.release,
+                                               args=(objs[1].filepath,))
+                pool_thread.start()
+                pool_thread.join(0.2)
+                assert second.is_open  # release() waits for the reader
+            pool_thread.join()
+            assert not second.is_open
+        finally:
+            pool.close()
+    finally:
+        shutil.rmtree(testdir)
+
 def test_JSON():
     data = dict(one=1, two=2.0, three=[4, 5])
     tmpf = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
@@ -36,6 +128,41 @@ def test_JSON():
     finally:
         os.unlink(pobj.filename)
 
+def test_JSON_compact():
+    data = dict(one=1, three=[4, 5])
+    testdir = tempfile.mkdtemp()
+    try:
+        pobj = JSON(os.path.join(testdir, 'compact.json'), compact=True)
+        pobj.save(data)
+        assert pobj.read() == data
+        with open(pobj.filepath) as f:
+            assert f.read() == '{"one":1,"three":[4,5]}'
+    finally:
+        shutil.rmtree(testdir)
+
+def test_JSONLines():
+    testdir = tempfile.mkdtemp()
+    try:
+        pobj = JSONLines(os.path.join(testdir, 'events.jsonl'))
+        pobj.save(({'frame': i} for i in range(3)))
+        assert pobj.read() == [{'frame': 0}, {'frame': 1}, {'frame': 2}]
+        pobj.append([{'frame': 3}, 'note\nwith newline'])
+        records = pobj.read(stream=True)
+        assert next(records) == {'frame': 0}
+        assert list(records)[-1] == 'note\nwith newline'
+        assert is_stream(JSONLines(pobj.filepath, stream=True).read())
+        def failing():
+            yield 1
+            raise ValueError
+        try:
+            pobj.save(failing())
+        except ValueError:
+            pass
+        assert len(pobj.read()) == 5  # Old version intact
+        assert os.listdir(testdir) == ['events.jsonl']
+    finally:
+        shutil.rmtree(testdir)
+
 def test_Pickle():
     data = dict(one=1, two=2.0, three=[4, 5], s={1, 2})
     tmpf = tempfile.NamedTemporaryFile(suffix='.pickle', delete=False)
@@ -52,6 +179,121 @@ def test_Pickle():
     finally:
         os.unlink(pobj.filename)
 
+def test_NumPy():
+    data = numpy.random.random((100, 3))
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        pobj = NumPy(testdir / 'array.npy')
+        pobj.save(data)
+        databounced = pobj.read()
+        assert isinstance(databounced, numpy.memmap)
+        assert numpy.array_equal(data, databounced)
+        pobj.save(data * 2)  # Existing map is unaffected
+        assert numpy.array_equal(data, databounced)
+        assert numpy.array_equal(data * 2, pobj.read())
+        pobj = NumPy(testdir / 'array.npy', mmap_mode=None)
+        assert not isinstance(pobj.read(), numpy.memmap)
+
+        for compress in (False, True):
+            pobj = NumPy(testdir / 'arrays.npz', compress=compress)
+            pobj.save({'a': data, 'b': numpy.arange(5)})
+            databounced = pobj.read()
+            assert sorted(databounced) == ['a', 'b']
+            assert numpy.array_equal(data, databounced['a'])
+        assert sorted(os.listdir(testdir)) == ['array.npy', 'arrays.npz']
+        try:
+            NumPy(testdir / 'objects.npy').save(numpy.array([{}, []]))
+        except ValueError:  # Object arrays need pickle
+            pass
+        else:
+            raise AssertionError('Saved an object array')
+        assert sorted(os.listdir(testdir)) == ['array.npy', 'arrays.npz']
+    finally:
+        shutil.rmtree(testdir)
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+def test_Parquet():
+    data = pandas.DataFrame({'a': numpy.arange(100), 'b': numpy.random.random(100),
+                             'c': ['x'] * 100})
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        pobj = Parquet(testdir / 'table.parquet')
+        pobj.save(data)
+        databounced = pobj.read()
+        assert (databounced.a == data.a).all()
+        assert list(databounced.columns) == ['a', 'b', 'c']
+        part = pobj.read(columns=['a', 'b'], filters=[('a', '>=', 90)])
+        assert list(part.columns) == ['a', 'b']
+        assert list(part.a) == list(range(90, 100))
+        pobj = Parquet(testdir / 'table.parquet', columns=['c'])
+        assert list(pobj.read().columns) == ['c']
+        pobj = Parquet(testdir / 'series.parquet')
+        pobj.save(data.b)
+        assert numpy.allclose(pobj.read().b, data.b)
+    finally:
+        shutil.rmtree(testdir)
+
+def test_ReadCache():
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        cache = ReadCache(max_bytes=10000)
+        a, b = Pickle(testdir / 'a.pickle'), Pickle(testdir / 'b.pickle')
+        a.save(list(range(100)))
+        b.save(list(range(100)))
+        first = cache.read(a)
+        assert cache.read(a) is first
+        assert (cache.hits, cache.misses) == (1, 1)
+        # Rewritten file is noticed
+        a.save(list(range(101)))
+        assert len(cache.read(a)) == 101
+        assert cache.misses == 2
+        # Least recently used entry goes first
+        cache.read(b)
+        cache.read(a)
+        cache.resize(a.filepath.size + 1)
+        assert len(cache) == 1
+        cache.read(a)
+        assert (cache.hits, cache.misses) == (3, 3)
+        cache.discard(a.filepath)
+        assert len(cache) == 0
+        # Disabled
+        cache.resize(0)
+        assert cache.read(a) is not cache.read(a)
+        assert len(cache) == 0
+    finally:
+        shutil.rmtree(testdir)
+
+def test_Pickle_options():
+    data = dict(arr=numpy.random.random((1000, 3)), df=pandas.DataFrame(
+        {'a': numpy.arange(100)}), s={1, 2}, t=numpy.arange(20)[::2])
+    testdir = Path(tempfile.mkdtemp())
+    try:
+        fn = testdir / 'test.pickle'
+        for compression in [None, 'gzip', 'bz2', 'lzma']:
+            for out_of_band in [False, True]:
+                pobj = Pickle(fn, compression=compression, out_of_band=out_of_band)
+                pobj.save(data)
+                # Any Pickle instance can read it
+                databounced = Pickle(fn).read()
+                assert numpy.array_equal(data['arr'], databounced['arr'])
+                assert (data['df'].a == databounced['df'].a).all()
+                assert data['s'] == databounced['s']
+                assert numpy.array_equal(data['t'], databounced['t'])
+                databounced['arr'][0, 0] = -1  # Writeable
+                if compression is None and not out_of_band:
+                    assert not open(fn, 'rb').read().startswith(b'TASKER')
+                else:
+                    header = open(fn, 'rb').read(200).split(b'\n')[1]
+                    assert json.loads(header.decode())['codec'] == compression
+        try:
+            Pickle(fn, compression='zip')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Expected ValueError')
+    finally:
+        shutil.rmtree(testdir)
+
 class parentdir(unittest.TestCase):
     def test_parentdir(self):
         """Check whether the file reference can be made absolute after construction."""
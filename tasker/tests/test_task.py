@@ -1,5 +1,6 @@
 import six
 import os
+import json
 import tempfile, unittest
 from path import Path
 import pandas
@@ -129,6 +130,7 @@ class TestTask(unittest.TestCase):
             assert Path('.').abspath().basename() == self.testdir.abspath().basename()
 
     def test_progress(self):
+        self.task.status_interval = 0  # Write every report
         @self.task.create_task([], ['progress.tag'])
         def exercise_progress(tsk, ins):
             mon = progress.Monitor([self.task.p])
@@ -167,6 +169,96 @@ class TestTask(unittest.TestCase):
                 assert stat['hi'] == 1.5
         self.task.exercise_progress()
 
+    def test_progress_interval(self):
+        """Progress reports can be rate-limited, and written on a thread."""
+        sfn = self.testdir / 'status.json'
+        prog = progress.Progress(filename=sfn, interval=60)
+        writes = []
+        orig_write = prog._write
+        def counting_write(info):
+            writes.append(info.get('current'))
+            orig_write(info)
+        prog._write = counting_write
+        prog.working()
+        for i in prog.tally(range(1000)):
+            pass
+        self.assertEqual(writes, [None, 1000])  # Status, then final count
+        self.assertEqual(prog.stopwatch.laps, 1000)
+        self.assertEqual(len(prog.stopwatch.laptimes), 1000)
+        self.assertEqual(prog.stopwatch.laptimes[-1], prog.stopwatch.last_lap)
+        prog._finish()
+        self.assertEqual(json.loads(sfn.text())['status'], 'done')
+        prog = progress.Progress(filename=sfn, background=True)
+        for i in prog.tally(range(100)):
+            pass
+        prog._finish()
+        prog.close()
+        info = json.loads(sfn.text())
+        self.assertEqual(info['status'], 'done')
+        self.assertEqual(info['total'], 100)
+        self.assertEqual(self.testdir.files('*._tmp'), [])
+        # Errors in the background are not lost
+        import time
+        prog = progress.StatusFile(filename=sfn, background=True)
+        def failing_write(info):
+            raise OSError('disk full')
+        prog._write = failing_write
+        prog.report({'current': 1})
+        for i in range(100):
+            if prog._error is not None:
+                break
+            time.sleep(0.01)
+        self.assertRaises(OSError, prog.report, {'current': 2})
+        prog.close()
+
+    def test_status_failure(self):
+        """A failed status write warns, and still releases the task."""
+        cwd = Path.getcwd()
+        @self.task.create_task([], storage.JSON('sf.json'))
+        def status_fails(tsk, ins):
+            # As if the background writer failed after the last report
+            tsk.progress._error = OSError('disk full')
+            return 1
+        with self.assertWarns(UserWarning):
+            self.assertEqual(self.task.status_fails(), 1)
+        assert not self.task._lockfile('status_fails').exists()
+        assert not self.task.status_fails._running
+        self.assertEqual(Path.getcwd(), cwd)
+        with self.assertWarns(UserWarning):
+            self.task.status_fails.force()  # Not locked out
+        assert self.task.status_fails.is_current()
+
+    def test_monitor_incremental(self):
+        """Monitor only re-reads status files that have changed."""
+        dirs = [self.testdir / ('d%i' % i) for i in range(6)]
+        for d in dirs[:4]:
+            d.makedirs_p()
+            progress.StatusFile({'task': 'x'}, d / progress.DEFAULT_STATUS_FILE
+                                ).update({'status': 'working', 'current': 1})
+        mon = progress.Monitor(dirs, workers=3)
+        reads = []
+        orig_check = mon._check
+        def counting_check(i):
+            res = orig_check(i)
+            if res is not None:
+                reads.append(i)
+            return res
+        mon._check = counting_check
+        stat = mon.get_statuses()
+        self.assertEqual(sorted(reads), list(range(6)))
+        self.assertEqual(list(stat.status), ['working'] * 4 + ['?'] * 2)
+        del reads[:]
+        progress.StatusFile({'task': 'x'}, dirs[2] / progress.DEFAULT_STATUS_FILE
+                            ).update({'status': 'done'})
+        stat = mon.get_statuses()
+        self.assertEqual(reads, [2])
+        self.assertEqual(stat.status[2], 'done')
+        self.assertEqual(stat.current[2], '')
+        self.assertEqual(stat.current[1], 1)
+        self.assertEqual(stat.since_update[5], '')
+        (dirs[0] / progress.DEFAULT_STATUS_FILE).unlink()
+        self.assertEqual(mon.get_statuses().status[0], '?')
+
     def test_locking(self):
         didrun = []
         @self.task.create_task([], ['dummy.tag'])
@@ -391,3 +483,558 @@ class TestNewStyleTasks(TestTask):
         except RuntimeError:
             pass
 
+    def test_diamond_walk(self):
+        """Shared upstream tasks are examined once per pass, not once per path."""
+        visits = []
+        @self.task.stores(storage.JSON('d0.json'))
+        def d0(tsk):
+            return 0
+        prev = d0
+        for i in range(1, 16):
+            # Each level has two branches that rejoin at the next level
+            @self.task.stores(storage.JSON('l%i.json' % i))
+            def left(tsk, up=prev):
+                return up
+            left.__name__ = 'l%i' % i
+            @self.task.stores(storage.JSON('r%i.json' % i))
+            def right(tsk, up=prev):
+                return up
+            right.__name__ = 'r%i' % i
+            @self.task.stores(storage.JSON('d%i.json' % i))
+            def join(tsk, l=left, r=right):
+                return l + r
+            join.__name__ = 'd%i' % i
+            prev = join
+        orig_output_mtime = task.TaskUnit._output_mtime
+        def counting_output_mtime(tsk, *args):
+            visits.append(tsk)
+            return orig_output_mtime(tsk, *args)
+        task.TaskUnit._output_mtime = counting_output_mtime
+        try:
+            self.assertEqual(len(prev.report()), 1 + 3 * 15)
+            self.assertEqual(len(visits), 1 + 3 * 15)
+            del visits[:]
+            assert prev() == 0
+            assert prev.is_current()
+        finally:
+            task.TaskUnit._output_mtime = orig_output_mtime
+
+    def test_cycle(self):
+        """A task that depends on itself is reported, not recursed forever."""
+        @self.task.stores(storage.JSON('cyc.json'))
+        def cyc(tsk, dep=self.task.one):
+            return dep
+        cyc.input_tasks.append(cyc)
+        self.assertRaises(RuntimeError, cyc.is_current)
+        # The failed pass leaves nothing behind to break the next one
+        self.assertRaises(RuntimeError, cyc.is_current)
+
+    def test_parallel_sync(self):
+        """Independent branches run in child processes."""
+        @self.task.stores(storage.JSON('pa.json'))
+        def pa(tsk, one=self.task.one):
+            return os.getpid()
+        @self.task.stores(storage.JSON('pb.json'))
+        def pb(tsk, one=self.task.one):
+            return os.getpid()
+        @self.task.stores(storage.JSON('pc.json'))
+        def pc(tsk, a=pa, b=pb):
+            return [a, b]
+        pc.sync(workers=2)
+        assert pc.is_current()
+        assert os.getpid() not in pc.load()
+        assert self.task.one_count == 0  # one() ran in a child, too
+        pc.sync(workers=2)  # Nothing to do
+
+    def test_parallel_sync_failure(self):
+        @self.task.stores(storage.JSON('pfail.json'))
+        def pfail(tsk, one=self.task.one):
+            raise ValueError()
+        @self.task.stores(storage.JSON('pdown.json'))
+        def pdown(tsk, f=pfail):
+            return f
+        self.assertRaises(RuntimeError, pdown.sync, workers=2)
+        assert self.task.one.is_current()
+        assert not (self.task.p / 'pdown.json').exists()
+        assert not self.task.is_working()
+
+    def test_hash_staleness(self):
+        """In "hash" mode, only changed input contents cause a re-run."""
+        self.task.staleness = 'hash'
+        input_file = storage.JSON(self.task.p / 'hash_input.json')
+        input_file.save(3)
+        runs = []
+        @self.task.stores(storage.JSON('hashed.json'))
+        def hashed(tsk, input_value=input_file):
+            runs.append(input_value)
+            return input_value
+        @self.task.stores(storage.JSON('hashed2.json'))
+        def hashed2(tsk, h=hashed):
+            runs.append(h)
+            return h
+        assert hashed2() == 3
+        self.assertEqual(len(runs), 2)
+        later = input_file.filepath.mtime + 100
+        os.utime(input_file.filepath, (later, later))  # touch
+        assert hashed2.is_current()
+        self.assertEqual(hashed2.report(), [])
+        assert hashed2() == 3
+        self.assertEqual(len(runs), 2)
+        input_file.save(3)  # Rewritten, same contents
+        hashed.force()  # Same output, so hashed2 need not run
+        self.assertEqual(len(runs), 3)
+        assert hashed2() == 3
+        self.assertEqual(len(runs), 3)
+        input_file.save(4)
+        os.utime(input_file.filepath, (later, later))
+        assert not hashed2.is_current()
+        assert hashed2() == 4
+        self.assertEqual(len(runs), 5)
+
+    def test_cache_status(self):
+        """Status queries are answered from the build state database."""
+        self.task.cache_status = True
+        walks = []
+        orig_walk_up = task.TaskUnit._walk_up
+        def counting_walk_up(tsk, *args, **kw):
+            if kw.get('walk') is None or not kw['walk'].results:  # New pass
+                walks.append(tsk)
+            return orig_walk_up(tsk, *args, **kw)
+        task.TaskUnit._walk_up = counting_walk_up
+        try:
+            assert not self.task.three.is_current()
+            self.assertEqual(len(self.task.three.report()), 3)
+            self.assertEqual(len(walks), 1)
+            self.task.three()
+            assert self.task.three.last_run() is not None
+            del walks[:]
+            assert self.task.three.is_current()
+            assert self.task.three.is_current()
+            self.assertEqual(self.task.three.report(), [])
+            self.assertEqual(len(walks), 1)  # Files changed since last query
+            self.task.menu()
+            self.assertEqual(len(walks), len(self.task.tasks))
+            self.task.menu()
+            self.assertEqual(len(walks), len(self.task.tasks))
+            # Changes to files are noticed
+            self.task.two.clear()
+            del walks[:]
+            assert not self.task.three.is_current()
+            self.assertEqual(set(self.task.three.report()),
+                             set([self.task.two, self.task.three]))
+            self.assertEqual(len(walks), 1)
+            # A broken database is worked around
+            self.task.build_state.close()
+            with open(self.task.build_state.filename, 'w') as f:
+                f.write('garbage' * 1000)
+            del walks[:]
+            with self.assertWarns(UserWarning):
+                assert not self.task.three.is_current()
+            self.assertEqual(len(walks), 1)
+            # ... even when recording a successful run
+            with self.assertWarns(UserWarning):
+                self.task.three.force()
+            assert self.task.three.output_files[0].exists()
+        finally:
+            task.TaskUnit._walk_up = orig_walk_up
+
+    def test_stat_cache(self):
+        """Files are listed a directory at a time, and each is looked at once."""
+        from tasker.metadata import StatCache
+        names = ['f%i.txt' % i for i in range(10)]
+        for n in names[:8]:
+            (self.testdir / n).touch()
+        stats = StatCache()
+        stats.prefetch([self.testdir / n for n in names] + ['/nonexistent/dir/file'])
+        self.assertEqual(len(stats._stats), 10)  # Lone file is left for later
+        assert stats.stat(self.testdir / 'f0.txt') is not None
+        assert stats.stat(self.testdir / 'f9.txt') is None
+        assert stats.stat('/nonexistent/dir/file') is None
+        self.assertRaises(OSError, stats.mtime, self.testdir / 'f9.txt')
+        (self.testdir / 'f9.txt').touch()
+        assert stats.stat(self.testdir / 'f9.txt') is None  # Still cached
+        stats.forget([self.testdir / 'f9.txt'])
+        assert stats.stat(self.testdir / 'f9.txt') is not None
+
+    def test_no_chdir(self):
+        """Tasks can run in threads without changing the working directory."""
+        import threading
+        self.task.chdir = False
+        cwd = os.getcwd()
+        seen = []
+        @self.task.stores(storage.JSON('ta.json'))
+        def ta(tsk, one=self.task.one):
+            seen.append((os.getcwd(), threading.current_thread().ident))
+            return one
+        @self.task.stores(storage.JSON('tb.json'))
+        def tb(tsk, one=self.task.one):
+            seen.append((os.getcwd(), threading.current_thread().ident))
+            (tsk.p / 'tb_side_file').touch()
+            return one
+        @self.task.stores(storage.JSON('tc.json'))
+        def tc(tsk, a=ta, b=tb):
+            return [a, b]
+        self.assertEqual(tc.sync(workers=2, threads=True), None)
+        self.assertEqual(tc(), ['one_str', 'one_str'])
+        self.assertEqual([d for d, thread in seen], [cwd, cwd])
+        assert threading.current_thread().ident not in [t for d, t in seen]
+        assert (self.task.p / 'tb_side_file').exists()
+        assert (self.task.p / progress.DEFAULT_STATUS_FILE).exists()
+        assert not self.task.is_working()
+        self.task.chdir = True
+        self.task.one.clear()
+        self.assertRaises(ValueError, tc.sync, workers=2, threads=True)
+
+    def test_sibling_working(self):
+        """A task is seen as running while a sibling reports over it."""
+        import threading, time
+        self.task.chdir = False
+        tkr = self.task
+        sa_started, sa_done = threading.Event(), threading.Event()
+        @tkr.stores(storage.JSON('sa.json'))
+        def sa(tsk):
+            sa_started.set()
+            assert sa_done.wait(10)
+            return 1
+        @tkr.stores(storage.JSON('sb.json'))
+        def sb(tsk):
+            assert sa_started.wait(10)
+            assert tkr.is_working('sa') and tkr.is_working('sb')
+            sa_done.set()
+            for i in range(500):  # Until sa has finished, and said so
+                if not tkr._lockfile('sa').exists():
+                    break
+                time.sleep(0.01)
+            status = json.loads((tkr.p / progress.DEFAULT_STATUS_FILE).text())
+            self.assertEqual((status['task'], status['status']), ('sa', 'done'))
+            assert not tkr.is_working('sa')
+            assert tkr.is_working('sb') and tkr.is_working()
+            return 2
+        @tkr.stores(storage.JSON('sc.json'))
+        def sc(tsk, a=sa, b=sb):
+            return a + b
+        sc.sync(workers=2, threads=True)
+        self.assertEqual(sc(), 3)
+        assert not tkr.is_working()
+
+    def test_thread_failure(self):
+        self.task.chdir = False
+        @self.task.stores(storage.JSON('tfail.json'))
+        def tfail(tsk, one=self.task.one):
+            raise ValueError()
+        try:
+            tfail.sync(workers=2, threads=True)
+        except RuntimeError as e:
+            assert isinstance(e.__cause__, ValueError)
+        else:
+            raise AssertionError('Expected RuntimeError')
+        assert self.task.one.is_current()
+
+    def test_read_cache(self):
+        """Upstream outputs are read from disk once, while unchanged."""
+        from tasker import cache
+        cache.set_read_cache(10 * 1024**2)
+        try:
+            self.task.three()
+            misses = cache.read_cache.misses
+            first = self.task.one.load()
+            self.task.gapped()
+            self.task.two.load()
+            self.assertEqual(cache.read_cache.misses, misses + 1)  # gapped.json
+            self.task.one.force()  # Rewrites one.json
+            self.assertEqual(self.task.one.load(), first)
+            self.assertEqual(cache.read_cache.misses, misses + 2)
+        finally:
+            cache.set_read_cache(0)
+
+    def test_handoff(self):
+        """Freshly computed outputs go straight to downstream tasks."""
+        self.task.handoff = True
+        @self.task.stores(storage.JSON('ho.json'))
+        def ho(tsk):
+            return (1, 2)
+        @self.task.stores(storage.JSON('ho2.json'))
+        def ho2(tsk, h=ho):
+            assert isinstance(h, tuple)  # Not read back from JSON
+            return list(h)
+        @self.task
+        def ho3(tsk, h=ho, h2=ho2):
+            return h, h2
+        self.assertEqual(ho3(), ([1, 2], [1, 2]))  # From disk, after sync
+        self.assertEqual(ho2.load(), [1, 2])
+
+    def test_write_behind(self):
+        """Outputs can be saved on a background thread."""
+        import threading
+        savers = []
+        tkr = self.task
+        class SlowJSON(storage.JSON):
+            def save(self, data):
+                import time
+                time.sleep(0.05)
+                savers.append(threading.current_thread().ident)
+                # Still locked, and not yet reported as done
+                name = os.path.splitext(os.path.basename(self.filename))[0]
+                assert tkr._lockfile(name).exists() and tkr.is_working()
+                super(SlowJSON, self).save(data)
+        self.task.write_behind = True
+        @self.task.stores(SlowJSON('wb.json'))
+        def wb(tsk):
+            return 5
+        @self.task.stores(SlowJSON('wb2.json'))
+        def wb2(tsk, w=wb):
+            return w + 1
+        @self.task.stores(storage.JSON('wb3.json'))
+        def wb3(tsk, w=wb2, fn='wb.json', saved=storage.JSON('wb.json')):
+            assert saved == 5  # Read after its deferred save
+            return w + 1
+        assert wb3() == 7
+        self.assertEqual(len(savers), 2)
+        assert threading.current_thread().ident not in savers
+        assert wb.is_current() and wb3.is_current()
+        self.task.staleness = 'hash'
+        self.task.clear()
+        assert wb3() == 7
+        assert wb3.is_current()
+        self.task.clear()
+        @self.task.stores(storage.JSON('wb_fail.json'))
+        def wb_fail(tsk, w=wb):
+            return set()  # Can't be saved as JSON
+        self.assertRaises(TypeError, wb_fail.sync)
+        assert wb.is_current()
+        assert not self.task.is_working()
+        # A sync inside a task function shares the background writer
+        self.task.clear()
+        runs = []
+        @self.task.stores(SlowJSON('wb5.json'))
+        def wb5(tsk, w=wb):
+            runs.append('wb5')
+            return w + 2
+        @self.task.stores(storage.JSON('wb6.json'))
+        def wb6(tsk, w=wb):
+            wb5.sync()
+            runs.append('wb6')
+            return w
+        assert wb6() == 5
+        assert wb5.is_current()
+        self.assertEqual(runs, ['wb5', 'wb6'])
+        self.assertEqual(wb5.load(), 7)
+        assert not self.task.is_working()
+
+    def test_write_behind_failure(self):
+        """Nothing is recorded for a task whose deferred save failed."""
+        from tasker.artifacts import ArtifactCache
+        cache = ArtifactCache(self.testdir / 'cache')
+        self.task.write_behind = True
+        self.task.staleness = 'hash'
+        self.task.cache_status = True
+        self.task.record_runs = True
+        self.task.artifact_cache = cache
+        (self.task.p / 'wbf_in.txt').write_text('1')
+        @self.task.stores(storage.JSON('wbf.json'))
+        def wbf(tsk, inp='wbf_in.txt'):
+            return {'a': 1, 'b': set()}  # Can't be saved as JSON
+        self.assertRaises(TypeError, wbf.sync)
+        assert not (self.task.p / 'wbf.json').exists()  # No partial file
+        assert not wbf.is_current()
+        self.assertEqual(cache.total_bytes(), 0)
+        assert wbf.last_run() is None
+        self.assertEqual(list(self.task.run_history().outcome), ['error'])
+        assert not self.task.is_working()
+
+    def test_asyncio(self):
+        """Tasks in several directories can be driven by an event loop."""
+        import asyncio
+        dirs = [Path(tempfile.mkdtemp()) for i in range(3)]
+        try:
+            taskers = [self.enter_dir(d) for d in dirs]
+            for t in taskers[1:]:
+                t.chdir = False
+            cwd = os.getcwd()
+            async def main():
+                three = await taskers[0].three.async_call()
+                results = await task.Tasker.gather(*[t.two for t in taskers[:2]],
+                                                   limit=1)
+                await taskers[1].gapped.async_sync()
+                gapped = await taskers[1].gapped.async_load()
+                failures = await task.Tasker.gather(
+                    taskers[2].doesnt_store, taskers[2].one,
+                    return_exceptions=True)
+                shared = await task.Tasker.gather(shared_x, shared_y)
+                return three, results, gapped, failures, shared
+            # Two tasks that need the same (slow) upstream task at once
+            import time
+            ups = []
+            @taskers[1].stores(storage.JSON('shared_up.json'))
+            def shared_up(tsk):
+                ups.append(1)
+                time.sleep(0.1)
+                return 1
+            @taskers[1].stores(storage.JSON('shared_x.json'))
+            def shared_x(tsk, up=shared_up):
+                return up + 1
+            @taskers[1].stores(storage.JSON('shared_y.json'))
+            def shared_y(tsk, up=shared_up):
+                return up + 2
+            taskers[2].one.clear()
+            (taskers[2].p / 'one.json').makedirs_p()  # Breaks "one"
+            three, results, gapped, failures, shared = asyncio.run(main())
+            self.assertEqual(shared, [2, 3])
+            self.assertEqual(ups, [1])  # Run once
+            self.assertEqual(three[0], 2.0)
+            self.assertEqual([r[1]['name'] for r in results],
+                             [t.name for t in taskers[:2]])
+            self.assertEqual(gapped, 2.0)
+            assert isinstance(failures[0], Exception)
+            assert isinstance(failures[1], Exception)
+            self.assertEqual(os.getcwd(), cwd)
+        finally:
+            os.chdir(basedir)
+            for d in dirs:
+                d.rmtree()
+
+    def test_select(self):
+        """Downstream tasks can read part of an upstream task's output."""
+        class Picky(storage.Pickle):
+            def read(self, key=None):
+                return super(Picky, self).read()[key]
+        @self.task.stores(Picky('picky.pickle'), 'picky_dummy')
+        def picky(tsk):
+            (tsk.p / 'picky_dummy').touch()
+            return {'x': 1, 'y': 2}, None
+        @self.task
+        def selector(tsk, p=picky.select(key='y')):
+            return p[0], p[1].basename()
+        assert picky in selector.input_tasks
+        self.assertEqual(selector(), (2, 'picky_dummy'))
+        self.assertEqual(picky.select(key='x').read()[0], 1)
+        self.assertRaises(ValueError, selector.select)
+
+    def test_lazy_load(self):
+        """Outputs can be read only when they are used."""
+        reads = []
+        class Counted(storage.JSON):
+            def read(self):
+                reads.append(self.filename)
+                return super(Counted, self).read()
+        @self.task.stores(Counted('big.json'), Counted('small.json'))
+        def two_files(tsk):
+            return [1, 2, 3], {'n': 3}
+        @self.task
+        def uses_small(tsk, t=two_files.select(lazy=True)):
+            return t[1]['n']
+        self.assertEqual(uses_small(), 3)
+        self.assertEqual(reads, ['small.json'])
+        big, small = two_files.load(lazy=True)
+        self.assertIsInstance(big, task.LazyOutput)
+        self.assertEqual(reads, ['small.json'])
+        self.assertEqual(len(big), 3)
+        self.assertEqual(list(big), [1, 2, 3])
+        self.assertEqual(big(), [1, 2, 3])
+        self.assertEqual(reads, ['small.json', 'big.json'])  # Read once
+
+    def test_shards(self):
+        """Only the shards whose inputs have changed are recomputed."""
+        segdir = self.task.p / 'segments'
+        segdir.makedirs_p()
+        for i in range(4):
+            (segdir / ('seg%i.txt' % i)).write_text(str(i))
+        runs = []
+        @self.task.shards(range(4), storage.JSON('feature_{key}.json'),
+                          inputs=lambda key: 'segments/seg%i.txt' % key, workers=2)
+        def feature(tsk, key, segment, scale=self.task.one):
+            runs.append(key)
+            return int(segment.text()) * len(scale)
+        @self.task.stores(storage.JSON('feature_total.json'))
+        def total(tsk, f=feature):
+            return sum(f.values())
+        self.assertEqual(total(), 6 * 7)
+        self.assertEqual(sorted(runs), [0, 1, 2, 3])
+        self.assertEqual(feature.load()[2], 14)
+        assert total.is_current()
+        past = self.task.p.joinpath('feature_3.json').mtime - 100
+        for fn in segdir.files() + [self.task.p / 'one.json']:
+            os.utime(fn, (past - 100, past - 100))
+        for fn in self.task.p.files('feature_*.json'):
+            os.utime(fn, (past, past))
+        (segdir / 'seg2.txt').write_text('10')
+        assert not total.is_current()
+        self.assertEqual(total(), (0 + 1 + 10 + 3) * 7)
+        self.assertEqual(sorted(runs), [0, 1, 2, 2, 3])
+        (self.task.p / 'feature_0.json').unlink()
+        self.assertEqual(feature._stale_keys(), [0])
+        feature.sync()
+        self.assertEqual(sorted(runs), [0, 0, 1, 2, 2, 3])
+        (self.task.p / 'feature_1.json').unlink()
+        del runs[:]
+        feature.force()  # All shards, not just the stale one
+        self.assertEqual(sorted(runs), [0, 1, 2, 3])
+        self.assertRaises(ValueError, self.task.shards(range(2), 'same.json'),
+                          lambda tsk, key: None)
+
+    def test_shards_hash(self):
+        """With "hash" staleness, shards are checked by their inputs' contents."""
+        self.task.staleness = 'hash'
+        for i in range(3):
+            (self.task.p / ('hseg%i.txt' % i)).write_text(str(i))
+        runs = []
+        @self.task.shards(['a', 'b', 'c'], storage.JSON('hfeat_{key}.json'),
+                          inputs=lambda key: 'hseg%i.txt' % 'abc'.index(key))
+        def hfeat(tsk, key, segment):
+            runs.append(key)
+            return key * int(segment.text())
+        self.assertEqual(hfeat(), {'a': '', 'b': 'b', 'c': 'cc'})
+        self.assertEqual(len(runs), 3)
+        later = self.task.p.joinpath('hfeat_c.json').mtime + 100
+        for i in range(3):  # Touch everything; change one
+            seg = self.task.p / ('hseg%i.txt' % i)
+            if i == 1:
+                seg.write_text('3')
+            os.utime(seg, (later, later))
+        self.assertEqual(hfeat()['b'], 'bbb')
+        self.assertEqual(runs, ['a', 'b', 'c', 'b'])
+
+    def test_pandas_outputs_one_file(self):
+        """Several Pandas outputs can share a file."""
+        @self.task.stores(storage.Pandas('shared.h5', key='a'),
+                          storage.Pandas('shared.h5', key='b'))
+        def shared(tsk, one=self.task.one):
+            return pandas.Series([1]), pandas.Series([2, 3])
+        a, b = shared()
+        self.assertEqual(list(a), [1])
+        self.assertEqual(list(b), [2, 3])
+
+    def test_record_runs(self):
+        """Resources used by each run can be recorded and summarized."""
+        self.task.record_runs = True
+        @self.task.stores(storage.JSON('big.json'))
+        def big(tsk, one=self.task.one):
+            return list(range(10000))
+        @self.task.stores(storage.JSON('fails.json'))
+        def fails(tsk, b=big):
+            raise ValueError()
+        self.assertRaises(ValueError, fails)
+        runs = self.task.run_history()
+        self.assertEqual(list(runs.task), ['one', 'big', 'fails'])
+        self.assertEqual(list(runs.outcome), ['done', 'done', 'error'])
+        assert (runs.wall_s >= 0).all() and (runs.cpu_s >= 0).all()
+        assert runs.output_bytes[1] > runs.output_bytes[0] > 0
+        self.assertEqual(runs.input_bytes[2], runs.output_bytes[1])
+        if task.ResourceMeter().start().stop()['peak_rss_bytes'] is not None:
+            assert (runs.peak_rss_bytes > 0).all()
+        profile = self.task.profile()
+        self.assertEqual(profile.errors['fails'], 1)
+        self.assertEqual(profile.runs['big'], 1)
+
+    def test_yield_chunks(self):
+        """A task can produce its output in pieces."""
+        self.task.handoff = True
+        @self.task.stores(storage.Pandas('chunked.h5'))
+        def chunked(tsk, one=self.task.one):
+            for i in range(3):
+                yield pandas.DataFrame({'x': [i] * 4}, index=range(i * 4, i * 4 + 4))
+        @self.task
+        def chunk_count(tsk, c=chunked.select(chunksize=5)):
+            return [len(piece) for piece in c]
+        self.assertEqual(chunk_count(), [5, 5, 2])
+        self.assertEqual(list(chunked().x), [0] * 4 + [1] * 4 + [2] * 4)
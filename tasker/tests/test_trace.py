@@ -0,0 +1,91 @@
+import os
+import json
+import tempfile, unittest
+from path import Path
+from tasker import task, storage, campaign
+from tasker.trace import TraceRecorder
+basedir = Path.getcwd()
+mypath = Path(__file__)
+sample_taskfile = mypath.dirname() / 'sample_taskfile.py'
+
+class tracetests(unittest.TestCase):
+    def setUp(self):
+        os.chdir(basedir)
+        self.testdir = Path(tempfile.mkdtemp())
+    def tearDown(self):
+        os.chdir(basedir)
+        self.testdir.rmtree()
+    def test_hooks(self):
+        tkr = task.Tasker(self.testdir)
+        @tkr.stores(storage.JSON('one.json'))
+        def one(tsk):
+            return 1
+        @tkr.stores(storage.JSON('two.json'))
+        def two(tsk, one=one):
+            return one + 1
+        seen = []
+        hook = tkr.add_hook(lambda event, phase, t, info:
+                            seen.append((t.__name__, event, phase, dict(info))))
+        two.sync()
+        steps = [s[:3] for s in seen]
+        self.assertEqual(steps[:2], [('one', 'stale_check', 'begin'),
+                                     ('one', 'stale_check', 'end')])
+        assert seen[1][3]['stale']
+        for name in ('one', 'two'):
+            for event in ('lock_wait', 'load_inputs', 'func', 'save'):
+                assert steps.index((name, event, 'begin')) < \
+                        steps.index((name, event, 'end'))
+        self.assertEqual([s[3]['filename'] for s in seen
+                          if s[1:3] == ('save', 'end')],
+                         [tkr.p / 'one.json', tkr.p / 'two.json'])
+        del seen[:]
+        two.sync()
+        self.assertEqual([s[:3] for s in seen if s[2] == 'end'],
+                         [('one', 'stale_check', 'end'), ('two', 'stale_check', 'end')])
+        assert not seen[-1][3]['stale']
+        tkr.remove_hook(hook)
+        two.force()
+        self.assertEqual(len(seen), 4)
+    def test_error(self):
+        tkr = task.Tasker(self.testdir)
+        @tkr.stores(storage.JSON('bad.json'))
+        def bad(tsk):
+            raise ZeroDivisionError
+        rec = TraceRecorder().attach(bad)
+        with self.assertRaises(ZeroDivisionError):
+            bad()
+        last = rec.events[-1]
+        self.assertEqual((last['name'], last['ph']), ('bad: func', 'E'))
+        assert last['args']['error']
+    def test_campaign(self):
+        sample_taskfile.copy(self.testdir / 'taskfile_sub.py')
+        names = ['a', 'b', 'c']
+        for name in names:
+            (self.testdir / name).makedirs_p()
+        tracefile = self.testdir / 'trace.json'
+        outcomes = campaign.run_campaign([self.testdir / n for n in names], 'two',
+                                         workers=2, trace=tracefile)
+        assert 'trace_events' not in outcomes.columns
+        with open(tracefile) as f:
+            events = json.load(f)['traceEvents']
+        funcs = [e for e in events if e['cat'] == 'func' and e['ph'] == 'B']
+        self.assertEqual(sorted((os.path.basename(e['args']['dir']), e['args']['task'])
+                                for e in funcs),
+                         [(n, t) for n in names for t in ('one', 'two')])
+        self.assertEqual(len([e for e in events if e['ph'] == 'B']),
+                         len([e for e in events if e['ph'] == 'E']))
+        ts = [e['ts'] for e in events]
+        self.assertEqual(ts, sorted(ts))
+    def test_remove_during_step(self):
+        tkr = task.Tasker(self.testdir)
+        rec = TraceRecorder()
+        @tkr.stores(storage.JSON('detached.json'))
+        def detached(tsk):
+            rec.detach()  # e.g. from another thread
+            return 1
+        rec.attach(detached)
+        detached()
+        self.assertEqual([e['ph'] for e in rec.events if e['cat'] == 'func'],
+                         ['B', 'E'])
+        self.assertEqual(len([e for e in rec.events if e['ph'] == 'B']),
+                         len([e for e in rec.events if e['ph'] == 'E']))
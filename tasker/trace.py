@@ -0,0 +1,86 @@
+#   Copyright 2014 Nathan C. Keim
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Timelines of task execution, in the Chrome trace event format.
+
+For example,
+
+    rec = TraceRecorder().attach(tasker.final_task)
+    tasker.final_task.sync()
+    rec.detach()
+    rec.save('trace.json')
+
+records the steps of every task run by the sync (see Tasker.add_hook()).
+Open the file in chrome://tracing or https://ui.perfetto.dev. For a
+campaign, see campaign.run_campaign(..., trace=FILENAME).
+"""
+import six
+import os, time
+import json
+import threading
+
+
+class TraceRecorder(object):
+    """A Tasker hook that records each step of each task as a trace event.
+
+    Events from all threads and processes can be combined (see extend()),
+    since they are timestamped with the system clock and labeled with the
+    process and thread IDs.
+    """
+    def __init__(self):
+        self.events = []
+        self._taskers = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event, phase, task, info):
+        args = dict(info, task=task.__name__, dir=str(task.tasker.p))
+        ev = {'name': '%s: %s' % (task.__name__, event), 'cat': event,
+              'ph': 'B' if phase == 'begin' else 'E',
+              'ts': time.time() * 1e6, 'pid': os.getpid(),
+              'tid': threading.current_thread().ident, 'args': args}
+        with self._lock:
+            self.events.append(ev)
+
+    def attach(self, task):
+        """Record 'task', and the tasks upstream of it (even in other directories)."""
+        stack, seen = [task], set()
+        while stack:
+            t = stack.pop()
+            if t in seen:
+                continue
+            seen.add(t)
+            if not any(tkr is t.tasker for tkr in self._taskers):
+                t.tasker.add_hook(self)
+                self._taskers.append(t.tasker)
+            stack.extend(t.input_tasks)
+        return self
+
+    def detach(self):
+        """Stop recording."""
+        for tkr in self._taskers:
+            tkr.remove_hook(self)
+        self._taskers = []
+
+    def extend(self, events):
+        """Add 'events' recorded elsewhere, e.g. in another process."""
+        with self._lock:
+            self.events.extend(events)
+
+    def save(self, filename):
+        """Write the events to 'filename', as JSON that trace viewers can open."""
+        with self._lock:
+            events = sorted(self.events, key=lambda ev: ev['ts'])
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                      default=str)